@@ -1,20 +1,60 @@
 # Internal API responsible for saving device registrations to the database.
 # Not exposed to external traffic — only the Statistics API calls this service.
 
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from fastapi import FastAPI, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from pydantic import BaseModel
-import psycopg2
+import asyncio
+import heapq
+import logging
 import os
+import psycopg2
+import socket
+import sys
+import threading
+import time
+import uuid
 
 # ---------------------------------------------------------------------------
 # App initialization
 # ---------------------------------------------------------------------------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Opens the DB pool before uvicorn starts accepting traffic (see warm_up
+    below) and closes it on shutdown. A failed warm-up does not stop the
+    pod — /ready retries it.
+
+    Also runs the periodic heavy-hitters flush, with a final flush on
+    shutdown so a rescheduled pod doesn't lose its last interval, and the
+    event-loop lag probe behind GET /metrics.
+    """
+    await warm_up()
+    flusher = asyncio.create_task(flush_heavy_hitters_periodically())
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    yield
+    lag_monitor.cancel()
+    flusher.cancel()
+    try:
+        await run_in_threadpool(persist_heavy_hitters)
+    except Exception as e:
+        logger.warning("heavy hitters: final flush failed (%s)", e.__class__.__name__)
+    if _db_pool is not None:
+        _db_pool.closeall()
+
+
 # Create the FastAPI app with metadata shown in the auto-generated /docs page
 app = FastAPI(
     title="Device Registration API",
     description="Internal API for registering devices in the database",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # ---------------------------------------------------------------------------
@@ -27,6 +67,56 @@ DB_NAME     = os.getenv("DB_NAME", "devicedb")
 DB_USER     = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
 
+# Connection pool — MIN connections are opened at startup, up to MAX are
+# opened on demand and then kept open; callers wait up to TIMEOUT seconds for one
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT  = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+
+# Seconds to wait for a new database connection before giving up
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+
+# On-demand profiling — disabled by default, and even when enabled every call
+# must present PROFILING_TOKEN in the X-Admin-Token header
+PROFILING_ENABLED            = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILING_TOKEN              = os.getenv("PROFILING_TOKEN", "")
+PROFILING_MAX_SECONDS        = 60
+PROFILING_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILING_SAMPLE_INTERVAL_MS", "5"))
+
+# The token is compared with the raw header bytes, and how non-ASCII text
+# becomes bytes depends on the client — only ASCII tokens can match reliably
+if PROFILING_ENABLED and not PROFILING_TOKEN.isascii():
+    raise RuntimeError("PROFILING_TOKEN must be ASCII")
+
+# Heavy hitters — top user_keys per device type, tracked in memory with a
+# bounded summary and persisted to the heavy_hitters table every interval
+HEAVY_HITTERS_CAPACITY       = int(os.getenv("HEAVY_HITTERS_CAPACITY", "1000"))
+HEAVY_HITTERS_FLUSH_INTERVAL = float(os.getenv("HEAVY_HITTERS_FLUSH_INTERVAL", "30"))
+
+# Instances whose rows haven't been rewritten for this long are folded into
+# the shared "*merged*" rows, so rows of long-gone processes don't pile up
+HEAVY_HITTERS_STALE_AFTER = HEAVY_HITTERS_FLUSH_INTERVAL * 10
+HEAVY_HITTERS_MERGED_POD  = "*merged*"
+
+# Identifies this pod — the pod name in Kubernetes
+POD_NAME = os.getenv("HOSTNAME") or socket.gethostname()
+
+# Identifies this process's rows in heavy_hitters: the pod name plus a random
+# suffix per start, so a container restarted under the same hostname gets
+# rows of its own instead of writing over its predecessor's
+HEAVY_HITTERS_INSTANCE = f"{POD_NAME}-{uuid.uuid4().hex[:8]}"
+
+# Largest batch accepted by POST /Device/register/batch
+REGISTRATION_BATCH_MAX_SIZE = int(os.getenv("REGISTRATION_BATCH_MAX_SIZE", "1000"))
+
+# Requests slower than this are logged with a per-stage breakdown (0 = off)
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "0"))
+
+# How often (seconds) the event-loop lag reported by GET /metrics is measured
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+logger = logging.getLogger("device-registration-api")
+
 # ---------------------------------------------------------------------------
 # Valid device types — used for input validation
 # ---------------------------------------------------------------------------
@@ -43,23 +133,600 @@ class RegisterRequest(BaseModel):
     deviceType: str
 
 # ---------------------------------------------------------------------------
-# Helper: database connection
+# Helper: database connection pool
 # ---------------------------------------------------------------------------
 
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+# One slot per pooled connection — ThreadedConnectionPool raises instead of
+# waiting when it is exhausted, so callers queue on this semaphore first
+_db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+
+
+class KeepAliveConnectionPool(ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool that keeps every returned connection open.
+    The stock pool keeps only minconn idle and closes the rest in putconn,
+    so under any real concurrency most requests would reconnect anyway.
+    minconn still decides how many connections are opened up front.
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        # putconn keeps up to self.minconn idle connections — let it keep all of them
+        self.minconn = maxconn
+
+    def discard_idle(self):
+        """Closes every idle connection, e.g. after the server dropped one of them."""
+        with self._lock:
+            while self._pool:
+                self._pool.pop().close()
+
+
+class PooledConnection:
+    """
+    A pooled psycopg2 connection that behaves like a plain one, except that
+    close() hands it back to the pool (rolling back any open transaction)
+    instead of closing the socket. Endpoints keep the usual
+    open / finally-close shape.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self.commit_sent = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def commit(self):
+        self.commit_sent = True
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            # A connection the server dropped is closed instead of pooled
+            self._pool.putconn(self._conn, close=bool(self._conn.closed))
+            self._conn = None
+            _db_pool_slots.release()
+            adjust_gauge("db_pool_connections_in_use", -1)
+
+
+def get_db_pool():
+    """
+    Returns the connection pool, creating it on first use. Creating the
+    pool opens DB_POOL_MIN_SIZE connections, so this raises if the
+    database is unreachable.
+    """
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = KeepAliveConnectionPool(
+                    DB_POOL_MIN_SIZE,
+                    DB_POOL_MAX_SIZE,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    dbname=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    connect_timeout=DB_CONNECT_TIMEOUT,
+                    # Notice a silently dropped connection while it sits idle in the pool
+                    keepalives=1,
+                    keepalives_idle=30,
+                    keepalives_interval=10,
+                    keepalives_count=3
+                )
+    return _db_pool
+
+
 def get_db_connection():
     """
-    Opens a new database connection using the env vars.
-    We open one per request and close it in the finally block
-    to avoid holding idle connections.
+    Borrows a connection from the pool, waiting up to DB_POOL_TIMEOUT
+    seconds when all of them are in use. Call close() in the finally
+    block as before — it returns the connection to the pool.
+    """
+    with track_gauge("db_pool_waiting_requests"):
+        acquired = _db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT)
+    if not acquired:
+        raise TimeoutError("database connection pool exhausted")
+
+    try:
+        pool = get_db_pool()
+        conn = PooledConnection(pool, pool.getconn())
+    except Exception:
+        _db_pool_slots.release()
+        raise
+
+    adjust_gauge("db_pool_connections_in_use", 1)
+    return conn
+
+
+def with_db_connection(work):
+    """
+    Runs work(conn) on a pooled connection and returns its result.
+
+    When PostgreSQL restarts or moves, every pooled connection is dead and
+    fails on first use. If that happens here, the connection and all idle
+    ones are discarded and work runs once more on a freshly opened
+    connection — unless it already sent COMMIT, which may have been applied.
+    Any other error rolls the transaction back and is raised.
+    """
+    for attempt in range(2):
+        conn = get_db_connection()
+        try:
+            mark_stage("db_connect")
+            return work(conn)
+        except Exception as e:
+            lost = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)) and conn.closed
+            if not lost:
+                conn.rollback()
+                raise
+            if attempt or conn.commit_sent:
+                raise
+            logger.warning("database connection lost (%s), reconnecting", e.__class__.__name__)
+            get_db_pool().discard_idle()
+        finally:
+            conn.close()
+
+# ---------------------------------------------------------------------------
+# Helper: saturation metrics (GET /metrics)
+# ---------------------------------------------------------------------------
+
+# Current value of each saturation gauge — how much work is queued or in
+# progress right now. Registrations mostly wait on PostgreSQL, which keeps
+# CPU low even when the pod is saturated; these gauges don't.
+_gauges = Counter()
+_gauges_lock = threading.Lock()
+
+# Last measured event-loop lag in seconds (see monitor_event_loop_lag)
+_event_loop_lag = 0.0
+
+METRICS_HELP = {
+    "http_requests_in_flight":    "Requests currently being handled (probes and /metrics excluded)",
+    "db_pool_connections_in_use": "Pooled database connections currently borrowed",
+    "db_pool_connections_max":    "Size limit of the database connection pool (DB_POOL_MAX_SIZE)",
+    "db_pool_waiting_requests":   "Callers waiting for a pooled database connection",
+    "event_loop_lag_seconds":     "How late the event loop ran a timer at the last check",
+}
+
+
+def adjust_gauge(name: str, delta: int):
+    """Moves a gauge up or down — threadpool workers and the event loop both call this."""
+    with _gauges_lock:
+        _gauges[name] += delta
+
+
+@contextmanager
+def track_gauge(name: str):
+    """Counts the enclosed block in the named gauge while it runs."""
+    adjust_gauge(name, 1)
+    try:
+        yield
+    finally:
+        adjust_gauge(name, -1)
+
+
+async def monitor_event_loop_lag():
+    """
+    Sleeps EVENT_LOOP_LAG_INTERVAL at a time and records how much later
+    than requested it woke up — time the loop spent busy with other work
+    (e.g. unpacking large msgpack batches) instead of serving requests.
+    """
+    global _event_loop_lag
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        _event_loop_lag = max(0.0, loop.time() - started - EVENT_LOOP_LAG_INTERVAL)
+
+
+def render_metrics() -> str:
+    """Renders the saturation metrics in the Prometheus text exposition format."""
+    with _gauges_lock:
+        values = dict(_gauges)
+    values["db_pool_connections_max"] = DB_POOL_MAX_SIZE
+    values["event_loop_lag_seconds"] = round(_event_loop_lag, 6)
+
+    lines = []
+    for name, help_text in METRICS_HELP.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {values.get(name, 0)}")
+    return "\n".join(lines) + "\n"
+
+# ---------------------------------------------------------------------------
+# Helper: warm-up (startup + readiness)
+# ---------------------------------------------------------------------------
+
+# Set once the DB pool is open — /ready reports 503 until then, so
+# Kubernetes never routes traffic to a cold pod
+_warm = False
+_warmup_ms = None
+
+# The warm-up attempt in progress, shared by everyone who asks meanwhile
+_warmup_attempt = None
+
+
+async def warm_up() -> bool:
+    """
+    Runs a warm-up attempt, or waits for the one already in progress.
+    While the database is down every /ready probe ends up here; sharing one
+    attempt keeps them from piling up threadpool threads (and starving
+    /health) behind a slow connect.
+    """
+    global _warmup_attempt
+    if _warmup_attempt is None:
+        _warmup_attempt = asyncio.ensure_future(_attempt_warm_up())
+        _warmup_attempt.add_done_callback(_clear_warmup_attempt)
+    # shield: a probe that times out must not cancel the attempt for the others
+    return await asyncio.shield(_warmup_attempt)
+
+
+def _clear_warmup_attempt(attempt):
+    global _warmup_attempt
+    if _warmup_attempt is attempt:
+        _warmup_attempt = None
+
+
+async def _attempt_warm_up() -> bool:
+    """
+    Opens the DB pool (DB_POOL_MIN_SIZE connections, each bounded by
+    DB_CONNECT_TIMEOUT) ahead of traffic.
+    """
+    global _warm, _warmup_ms
+    started = time.perf_counter()
+
+    try:
+        await run_in_threadpool(get_db_pool)
+    except Exception as e:
+        logger.warning("warm-up: database not reachable yet (%s)", e.__class__.__name__)
+        return False
+
+    _warmup_ms = round((time.perf_counter() - started) * 1000, 1)
+    _warm = True
+    return True
+
+# ---------------------------------------------------------------------------
+# Helper: heavy hitters (top user_keys per device type)
+# ---------------------------------------------------------------------------
+
+class SpaceSaving:
+    """
+    Space-Saving summary (Metwally et al., 2005) — tracks at most `capacity`
+    keys. When it is full, a new key replaces the key with the smallest
+    count and inherits that count + 1, so counts are upper bounds. Any key
+    seen more than total / capacity times is guaranteed to be tracked.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts = {}
+        # (count, key) min-heap; entries whose count no longer matches
+        # self.counts are stale and skipped when popping
+        self._heap = []
+
+    def add(self, key: str):
+        count = self.counts.get(key)
+        if count is None:
+            if len(self.counts) < self.capacity:
+                count = 0
+            else:
+                count, evicted = self._pop_min()
+                del self.counts[evicted]
+
+        self.counts[key] = count + 1
+        heapq.heappush(self._heap, (count + 1, key))
+
+        # Stale entries accumulate on every increment — rebuild now and then
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(c, k) for k, c in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count, key = heapq.heappop(self._heap)
+            if self.counts.get(key) == count:
+                return count, key
+
+
+_heavy_hitters = {device_type: SpaceSaving(HEAVY_HITTERS_CAPACITY) for device_type in VALID_DEVICE_TYPES}
+_heavy_hitters_lock = threading.Lock()
+
+
+def record_heavy_hitter(device_type: str, user_key: str):
+    """Counts one registration of user_key in the in-memory summary."""
+    with _heavy_hitters_lock:
+        _heavy_hitters[device_type].add(user_key)
+
+
+def merge_summaries(left: dict, right: dict, capacity: int) -> dict:
+    """
+    Merges two Space-Saving summaries ({key: count}) into one of at most
+    `capacity` keys. A key missing from a full summary may still have been
+    seen there up to that summary's smallest count, so it is given that
+    count — merged counts stay upper bounds, like the summaries themselves.
+    """
+    def floor(summary):
+        return min(summary.values()) if len(summary) >= capacity else 0
+
+    left_floor, right_floor = floor(left), floor(right)
+    merged = {
+        key: left.get(key, left_floor) + right.get(key, right_floor)
+        for key in left.keys() | right.keys()
+    }
+    return dict(heapq.nlargest(capacity, merged.items(), key=lambda item: item[1]))
+
+
+# Whether this process's rows are in heavy_hitters (set after the first flush
+# that wrote any) — if they vanish, another pod has folded them
+_heavy_hitters_persisted = False
+
+
+def persist_heavy_hitters():
+    """
+    Replaces this process's rows in heavy_hitters with its summaries. The
+    summaries are never reset, so each row holds the Space-Saving count
+    since this process started — an upper bound of what it saw here.
+
+    Rows of an instance that stopped flushing (all of them older than
+    HEAVY_HITTERS_STALE_AFTER) are folded into the shared "*merged*"
+    summary with merge_summaries(). statistics-api sums all rows at read
+    time.
+    """
+    global _heavy_hitters_persisted
+
+    with _heavy_hitters_lock:
+        rows = [
+            (HEAVY_HITTERS_INSTANCE, device_type, user_key, count)
+            for device_type, summary in _heavy_hitters.items()
+            for user_key, count in summary.counts.items()
+        ]
+
+    if write_heavy_hitters(rows, expect_previous=_heavy_hitters_persisted):
+        _heavy_hitters_persisted = bool(rows)
+        return
+
+    # This process couldn't flush for HEAVY_HITTERS_STALE_AFTER and another
+    # pod folded its rows — those counts are in "*merged*" now. Start over
+    # rather than write them a second time (counts recorded since the last
+    # successful flush are lost).
+    logger.warning("heavy hitters: rows were folded while this process was unable to flush, starting over")
+    with _heavy_hitters_lock:
+        for device_type in _heavy_hitters:
+            _heavy_hitters[device_type] = SpaceSaving(HEAVY_HITTERS_CAPACITY)
+    _heavy_hitters_persisted = False
+
+
+def write_heavy_hitters(rows: list, expect_previous: bool) -> bool:
+    """
+    Writes one flush (see persist_heavy_hitters) in a single transaction.
+    Returns False, writing nothing of its own, if this process's previous
+    rows were expected but are gone.
     """
-    return psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
+
+    def write(conn):
+        cursor = conn.cursor()
+
+        cursor.execute("DELETE FROM heavy_hitters WHERE pod_name = %s", (HEAVY_HITTERS_INSTANCE,))
+        written = not (expect_previous and cursor.rowcount == 0)
+        if written and rows:
+            execute_values(
+                cursor,
+                "INSERT INTO heavy_hitters (pod_name, device_type, user_key, count) VALUES %s",
+                rows
+            )
+
+        fold_stale_heavy_hitters(cursor)
+        conn.commit()
+        return written
+
+    return with_db_connection(write)
+
+
+def fold_stale_heavy_hitters(cursor):
+    """
+    Folds the rows of instances that stopped flushing into the "*merged*"
+    rows, one instance summary at a time. Live instances rewrite all their
+    rows every flush, so an instance is only stale once all of its rows are.
+    """
+    params = {"merged": HEAVY_HITTERS_MERGED_POD, "stale_after": HEAVY_HITTERS_STALE_AFTER}
+    cursor.execute(
+        """
+        SELECT 1 FROM heavy_hitters
+        WHERE pod_name <> %(merged)s
+        GROUP BY pod_name
+        HAVING MAX(updated_at) < CURRENT_TIMESTAMP - make_interval(secs => %(stale_after)s)
+        LIMIT 1
+        """,
+        params
+    )
+    if cursor.fetchone() is None:
+        return
+
+    # Pods folding at the same time would overwrite each other's "*merged*" rows
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (HEAVY_HITTERS_MERGED_POD,))
+    # Same check again under the lock — another pod may have folded them already
+    cursor.execute(
+        """
+        DELETE FROM heavy_hitters
+        WHERE pod_name IN (
+            SELECT pod_name FROM heavy_hitters
+            WHERE pod_name <> %(merged)s
+            GROUP BY pod_name
+            HAVING MAX(updated_at) < CURRENT_TIMESTAMP - make_interval(secs => %(stale_after)s)
+        )
+        RETURNING pod_name, device_type, user_key, count
+        """,
+        params
+    )
+    summaries = defaultdict(dict)
+    for pod_name, device_type, user_key, count in cursor.fetchall():
+        summaries[device_type, pod_name][user_key] = count
+    if not summaries:
+        return
+
+    cursor.execute(
+        "DELETE FROM heavy_hitters WHERE pod_name = %s RETURNING device_type, user_key, count",
+        (HEAVY_HITTERS_MERGED_POD,)
+    )
+    merged = defaultdict(dict)
+    for device_type, user_key, count in cursor.fetchall():
+        merged[device_type][user_key] = count
+
+    for (device_type, _), summary in summaries.items():
+        merged[device_type] = merge_summaries(merged[device_type], summary, HEAVY_HITTERS_CAPACITY)
+
+    execute_values(
+        cursor,
+        "INSERT INTO heavy_hitters (pod_name, device_type, user_key, count) VALUES %s",
+        [
+            (HEAVY_HITTERS_MERGED_POD, device_type, user_key, count)
+            for device_type, summary in merged.items()
+            for user_key, count in summary.items()
+        ]
     )
 
+
+async def flush_heavy_hitters_periodically():
+    """Background task: persist_heavy_hitters() every HEAVY_HITTERS_FLUSH_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(HEAVY_HITTERS_FLUSH_INTERVAL)
+        try:
+            await run_in_threadpool(persist_heavy_hitters)
+        except Exception as e:
+            logger.warning("heavy hitters: flush failed (%s)", e.__class__.__name__)
+
+# ---------------------------------------------------------------------------
+# Helper: diagnostics (sampling profiler + slow-request timer)
+# ---------------------------------------------------------------------------
+
+# Only one profile may run at a time — two samplers would skew each other
+_profiling_lock = threading.Lock()
+
+# Stage marks of the current request, set by the slow-request middleware.
+# None means the timer is off and mark_stage() does nothing.
+_request_stages: ContextVar = ContextVar("request_stages", default=None)
+
+
+def collect_stack_samples(seconds: float, interval_ms: float) -> str:
+    """
+    Samples the stack of every thread in the process (except the sampler)
+    for the given number of seconds and returns them in collapsed-stack
+    format — one "outer;...;inner count" line per distinct stack — which
+    flamegraph.pl and speedscope read directly.
+
+    This is a wall-clock profiler: idle threadpool workers show up waiting
+    in threading.py, and the event loop shows up in select() when idle.
+    """
+    samples = Counter()
+    sampler_id = threading.get_ident()
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(interval_ms / 1000)
+
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+def mark_stage(name: str):
+    """
+    Records that the named stage of the current request just finished.
+    The slow-request middleware turns the marks into a per-stage breakdown.
+    """
+    stages = _request_stages.get()
+    if stages is not None:
+        stages.append((name, time.perf_counter()))
+
+# ---------------------------------------------------------------------------
+# Middleware
+# ---------------------------------------------------------------------------
+
+# Not counted as in-flight work — probes and scrapes would only add noise
+UNTRACKED_PATHS = {"/health", "/ready", "/metrics"}
+
+
+class InFlightTracker:
+    """
+    Counts requests in progress for the http_requests_in_flight gauge.
+    Plain ASGI middleware, like SlowRequestTimer below.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in UNTRACKED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        with track_gauge("http_requests_in_flight"):
+            await self.app(scope, receive, send)
+
+
+app.add_middleware(InFlightTracker)
+
+
+class SlowRequestTimer:
+    """
+    Logs requests slower than SLOW_REQUEST_THRESHOLD_MS together with the
+    time spent in each stage marked by the endpoint (see mark_stage).
+
+    Plain ASGI middleware, and only installed when the threshold is set —
+    a BaseHTTPMiddleware layer costs every request even when it does nothing.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or SLOW_REQUEST_THRESHOLD_MS <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        stages = []
+        status_code = 500  # if the app fails before sending a response
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        token = _request_stages.set(stages)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _request_stages.reset(token)
+            end = time.perf_counter()
+
+            elapsed_ms = (end - start) * 1000
+            if elapsed_ms >= SLOW_REQUEST_THRESHOLD_MS:
+                breakdown = []
+                previous = start
+                for name, at in stages + [("rest", end)]:
+                    breakdown.append(f"{name}={(at - previous) * 1000:.1f}ms")
+                    previous = at
+                logger.warning(
+                    "slow request: %s %s %.1fms (status %d) %s",
+                    scope["method"], scope["path"], elapsed_ms,
+                    status_code, " ".join(breakdown)
+                )
+
+
+if SLOW_REQUEST_THRESHOLD_MS > 0:
+    app.add_middleware(SlowRequestTimer)
+
 # ---------------------------------------------------------------------------
 # Endpoints
 # ---------------------------------------------------------------------------
@@ -72,6 +739,31 @@ def health_check():
     return {"status": "ok", "service": "device-registration-api"}
 
 
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness probe. Returns 503 until the pod is warm (DB pool open),
+    retrying the warm-up on each call, so traffic never lands on a cold pod.
+    /health stays a pure liveness check.
+    """
+    if not _warm and not await warm_up():
+        return JSONResponse(
+            status_code=503,
+            content={"status": "warming_up", "service": "device-registration-api"}
+        )
+    return {"status": "ready", "service": "device-registration-api", "warmupMs": _warmup_ms}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Saturation gauges in Prometheus text format, for custom-metrics
+    autoscaling (see k8s/device-registration-api/hpa.yaml). Async on
+    purpose: a scrape must not queue behind a full threadpool.
+    """
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/Device/register")
 def register_device(request: RegisterRequest):
     """
@@ -96,31 +788,161 @@ def register_device(request: RegisterRequest):
             status_code=400,
             content={"statusCode": 400}
         )
+    mark_stage("validate")
 
-    conn = None
-    try:
-        conn = get_db_connection()
+    def insert_registration(conn):
         cursor = conn.cursor()
 
         # Parameterized INSERT — %s placeholders prevent SQL injection
-        # created_at is handled by the DEFAULT in the table schema (see init.sql)
+        # created_at is handled by the DEFAULT in the table schema (see init.sql).
+        # device_type_code() maps the name to the stored SMALLINT (see init.sql).
+        # pg_notify tells every Statistics API pod that this device type's
+        # count changed; PostgreSQL delivers it only if the commit succeeds.
         cursor.execute(
-            "INSERT INTO device_registrations (user_key, device_type) VALUES (%s, %s)",
-            (request.userKey.strip(), request.deviceType)
+            "WITH registered AS ("
+            "INSERT INTO device_registrations (user_key, device_type) VALUES (%s, device_type_code(%s))"
+            ") SELECT pg_notify('device_registrations', %s)",
+            (request.userKey.strip(), request.deviceType, request.deviceType)
         )
+        mark_stage("db_insert")
 
         conn.commit()
+        mark_stage("db_commit")
+
+    try:
+        with_db_connection(insert_registration)
+    except Exception as e:
+        return JSONResponse(
+            status_code=400,
+            content={"statusCode": 400}
+        )
 
-        return {"statusCode": 200}
+    record_heavy_hitter(request.deviceType, request.userKey.strip())
+
+    return {"statusCode": 200}
+
+
+@app.post("/Device/register/batch")
+async def register_devices_batch(request: Request):
+    """
+    Compact internal transport: saves many registrations in one call.
+    The Statistics API uses it when DEVICE_API_PROTOCOL=msgpack, coalescing
+    concurrent POST /Log/auth calls into one request.
+
+    Body (application/msgpack): array of [userKey, deviceType] pairs.
+    Response (application/msgpack): array of status codes, one per pair in
+    the same order — 200 saved, 400 invalid pair or database error.
+    All valid pairs go into the database with a single INSERT and commit.
+
+    Returns:
+        200 — msgpack array of per-item status codes
+        400 — {"statusCode": 400} body is not a msgpack array or is too large
+    """
+    import msgpack  # only loaded when the compact transport is in use
 
+    try:
+        items = msgpack.unpackb(await request.body())
     except Exception as e:
-        if conn:
-            conn.rollback()
+        items = None
+
+    if not isinstance(items, list) or len(items) > REGISTRATION_BATCH_MAX_SIZE:
         return JSONResponse(
             status_code=400,
             content={"statusCode": 400}
         )
+    mark_stage("decode")
+
+    statuses = await run_in_threadpool(save_registrations, items)
+
+    return Response(content=msgpack.packb(statuses), media_type="application/msgpack")
+
+
+def save_registrations(items: list) -> list:
+    """
+    Validates each [userKey, deviceType] pair with the same rules as
+    POST /Device/register and inserts the valid ones in one statement.
+    Returns a status code per item; a database error fails every valid item.
+    """
+    statuses = []
+    rows = []
+    for item in items:
+        if (
+            isinstance(item, list) and len(item) == 2
+            and isinstance(item[0], str) and item[0].strip()
+            and isinstance(item[1], str) and item[1] in VALID_DEVICE_TYPES
+        ):
+            rows.append((item[0].strip(), item[1]))
+            statuses.append(200)
+        else:
+            statuses.append(400)
+
+    if not rows:
+        return statuses
+
+    def insert_registrations(conn):
+        cursor = conn.cursor()
+
+        # One multi-row INSERT for the whole batch — values are still sent as parameters.
+        # Identical notifications in one transaction are delivered once, so
+        # listeners get one per device type in the batch.
+        execute_values(
+            cursor,
+            "WITH batch (user_key, device_type) AS (VALUES %s), "
+            "registered AS ("
+            "INSERT INTO device_registrations (user_key, device_type) "
+            "SELECT user_key, device_type_code(device_type) FROM batch"
+            ") SELECT pg_notify('device_registrations', device_type) FROM batch GROUP BY device_type",
+            rows,
+            page_size=len(rows)
+        )
+        mark_stage("db_insert")
+
+        conn.commit()
+        mark_stage("db_commit")
+
+    try:
+        with_db_connection(insert_registrations)
+    except Exception as e:
+        return [400] * len(statuses)
 
+    for user_key, device_type in rows:
+        record_heavy_hitter(device_type, user_key)
+
+    return statuses
+
+
+@app.get("/debug/profile", include_in_schema=False)
+def profile(
+    seconds: float = Query(10, gt=0, le=PROFILING_MAX_SECONDS, description="How long to sample for"),
+    x_admin_token: str = Header(None)
+):
+    """
+    Admin-only: samples the live process for N seconds and returns the
+    stacks in collapsed-stack format (pipe into flamegraph.pl or load in
+    speedscope). Runs in the threadpool, so traffic keeps being served
+    while it samples.
+
+    Returns:
+        200 — collapsed stacks as text/plain
+        403 — missing or wrong X-Admin-Token
+        404 — profiling is disabled (the default)
+        409 — another profile is already running
+    """
+    if not PROFILING_ENABLED:
+        return JSONResponse(status_code=404, content={"detail": "Not Found"})
+
+    import hmac  # only needed here, keep it off the startup path
+
+    # Compare bytes — compare_digest raises on non-ASCII str. Header values
+    # arrive latin-1 decoded, so encoding them back never fails; the token
+    # is ASCII (checked at startup), the same bytes in either encoding.
+    presented = (x_admin_token or "").encode("latin-1")
+    if not PROFILING_TOKEN or not hmac.compare_digest(presented, PROFILING_TOKEN.encode("latin-1")):
+        return JSONResponse(status_code=403, content={"detail": "Forbidden"})
+
+    if not _profiling_lock.acquire(blocking=False):
+        return JSONResponse(status_code=409, content={"detail": "Profile already running"})
+    try:
+        return PlainTextResponse(collect_stack_samples(seconds, PROFILING_SAMPLE_INTERVAL_MS))
     finally:
-        if conn:
-            conn.close()
\ No newline at end of file
+        _profiling_lock.release()
@@ -3,13 +3,18 @@
 import pytest
 from fastapi.testclient import TestClient
 from unittest.mock import Mock, patch
+import asyncio
+import msgpack
+import psycopg2
 import sys
 import os
+import time
 
 # Add parent directory to path so we can import main
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from main import app, VALID_DEVICE_TYPES
+from main import app, KeepAliveConnectionPool, SlowRequestTimer, VALID_DEVICE_TYPES, DB_POOL_MAX_SIZE, get_db_connection
+from main import SpaceSaving, merge_summaries, persist_heavy_hitters, render_metrics, warm_up, METRICS_HELP
 
 # Create test client
 client = TestClient(app)
@@ -25,6 +30,125 @@ class TestHealthEndpoint:
         assert response.json() == {"status": "ok", "service": "device-registration-api"}
 
 
+class TestReadinessEndpoint:
+    """Tests for GET /ready and the startup warm-up"""
+
+    @pytest.fixture(autouse=True)
+    def cold_pod(self):
+        """Each test starts from a pod that has not warmed up yet"""
+        with patch('main._warm', False), patch('main._warmup_ms', None):
+            yield
+
+    @patch('main.get_db_pool')
+    def test_ready_returns_503_while_database_unreachable(self, mock_pool):
+        """Readiness should fail until the DB pool can be opened"""
+        mock_pool.side_effect = psycopg2.OperationalError("connection refused")
+
+        response = client.get("/ready")
+
+        assert response.status_code == 503
+        assert response.json()["status"] == "warming_up"
+
+    @patch('main.get_db_pool')
+    def test_ready_after_warm_up(self, mock_pool):
+        """Readiness should flip once the pool is open and stay ready"""
+        first = client.get("/ready")
+        second = client.get("/ready")
+
+        assert first.status_code == 200
+        assert first.json()["status"] == "ready"
+        assert second.status_code == 200
+        mock_pool.assert_called_once()
+
+    def test_concurrent_warm_ups_share_one_attempt(self):
+        """Probes arriving during a slow connect should wait for it, not start their own"""
+        attempts = []
+
+        def slow_pool():
+            attempts.append(1)
+            time.sleep(0.05)
+
+        async def probes():
+            return await asyncio.gather(*(warm_up() for _ in range(5)))
+
+        with patch('main.get_db_pool', side_effect=slow_pool):
+            results = asyncio.run(probes())
+
+        assert results == [True] * 5
+        assert len(attempts) == 1
+
+
+class TestConnectionPool:
+    """Tests for the pooled get_db_connection()"""
+
+    @patch('main.get_db_pool')
+    def test_close_returns_connection_to_pool(self, mock_pool):
+        """close() on a borrowed connection should put it back, not close it"""
+        raw_conn = Mock(closed=0)
+        mock_pool.return_value.getconn.return_value = raw_conn
+
+        conn = get_db_connection()
+        conn.close()
+
+        mock_pool.return_value.putconn.assert_called_once_with(raw_conn, close=False)
+        raw_conn.close.assert_not_called()
+
+    @patch('psycopg2.connect')
+    def test_pool_keeps_returned_connections_open(self, mock_connect):
+        """Returning more than minconn connections should keep them all for reuse"""
+        mock_connect.side_effect = lambda *args, **kwargs: Mock(
+            closed=False, info=Mock(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        )
+        pool = KeepAliveConnectionPool(2, 10)
+
+        borrowed = [pool.getconn() for _ in range(5)]
+        for conn in borrowed:
+            pool.putconn(conn)
+
+        for conn in borrowed:
+            conn.close.assert_not_called()
+        reused = [pool.getconn() for _ in range(5)]
+        assert sorted(map(id, reused)) == sorted(map(id, borrowed))
+        assert mock_connect.call_count == 5
+
+    @patch('psycopg2.connect')
+    def test_registration_survives_database_restart(self, mock_connect):
+        """Pooled connections killed by a database restart should be replaced, not fail the request"""
+        opened = []
+
+        def connect(*args, **kwargs):
+            conn = Mock(closed=0, info=Mock(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE))
+            if len(opened) < 2:  # opened before the restart
+                def lost(*args):
+                    conn.closed = 2
+                    raise psycopg2.OperationalError("server closed the connection unexpectedly")
+                conn.cursor.return_value.execute.side_effect = lost
+            opened.append(conn)
+            return conn
+
+        mock_connect.side_effect = connect
+        pool = KeepAliveConnectionPool(2, 10)
+
+        with patch('main.get_db_pool', return_value=pool):
+            response = client.post("/Device/register", json={"userKey": "user123", "deviceType": "iOS"})
+
+        assert response.status_code == 200
+        assert len(opened) == 3
+        opened[2].commit.assert_called_once()
+
+    @patch('main.DB_POOL_TIMEOUT', 0.01)
+    @patch('main.get_db_pool')
+    def test_exhausted_pool_times_out(self, mock_pool):
+        """Borrowing beyond DB_POOL_MAX_SIZE should wait, then raise"""
+        borrowed = [get_db_connection() for _ in range(DB_POOL_MAX_SIZE)]
+        try:
+            with pytest.raises(TimeoutError):
+                get_db_connection()
+        finally:
+            for conn in borrowed:
+                conn.close()
+
+
 class TestRegisterDeviceEndpoint:
     """Tests for POST /Device/register"""
 
@@ -122,7 +246,88 @@ class TestRegisterDeviceEndpoint:
 
         # Verify execute was called with trimmed userKey
         call_args = mock_cursor.execute.call_args
-        assert call_args[0][1] == ("user123", "Watch")
+        assert call_args[0][1] == ("user123", "Watch", "Watch")
+
+
+class TestRegisterBatchEndpoint:
+    """Tests for POST /Device/register/batch (msgpack transport)"""
+
+    def _post_batch(self, items):
+        return client.post(
+            "/Device/register/batch",
+            content=msgpack.packb(items),
+            headers={"Content-Type": "application/msgpack"}
+        )
+
+    @patch('main.record_heavy_hitter')
+    @patch('main.execute_values')
+    @patch('main.get_db_connection')
+    def test_batch_saves_valid_items_in_one_insert(self, mock_db_conn, mock_execute_values, mock_record):
+        """Valid pairs should be inserted together; each item gets its own status"""
+        mock_conn = Mock()
+        mock_conn.cursor.return_value = Mock()
+        mock_db_conn.return_value = mock_conn
+
+        response = self._post_batch([
+            ["user-a", "iOS"],
+            ["user-b", "Windows"],
+            ["   ", "TV"],
+            [" user-c ", "Watch"],
+            "not-a-pair",
+            ["user-d", ["iOS"]],
+            ["user-e", {"a": 1}],
+        ])
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/msgpack"
+        assert msgpack.unpackb(response.content) == [200, 400, 400, 200, 400, 400, 400]
+
+        mock_execute_values.assert_called_once()
+        assert mock_execute_values.call_args[0][2] == [("user-a", "iOS"), ("user-c", "Watch")]
+        mock_conn.commit.assert_called_once()
+        mock_conn.close.assert_called_once()
+        assert mock_record.call_count == 2
+
+    @patch('main.execute_values')
+    @patch('main.get_db_connection')
+    def test_batch_database_error_fails_all_items(self, mock_db_conn, mock_execute_values):
+        """A failed INSERT should roll back and fail every item"""
+        mock_conn = Mock()
+        mock_conn.cursor.return_value = Mock()
+        mock_db_conn.return_value = mock_conn
+        mock_execute_values.side_effect = Exception("Database error")
+
+        response = self._post_batch([["user-a", "iOS"], ["user-b", "TV"]])
+
+        assert msgpack.unpackb(response.content) == [400, 400]
+        mock_conn.rollback.assert_called_once()
+        mock_conn.close.assert_called_once()
+
+    @patch('main.get_db_connection')
+    def test_batch_without_valid_items_skips_database(self, mock_db_conn):
+        """A batch with nothing valid should not open a connection"""
+        response = self._post_batch([["user-a", "Linux"]])
+
+        assert msgpack.unpackb(response.content) == [400]
+        mock_db_conn.assert_not_called()
+
+    def test_batch_rejects_malformed_body(self):
+        """A body that is not a msgpack array should return 400"""
+        response = client.post(
+            "/Device/register/batch",
+            content=b"\xc1 not msgpack",
+            headers={"Content-Type": "application/msgpack"}
+        )
+        assert response.status_code == 400
+
+        response = self._post_batch({"userKey": "user-a"})
+        assert response.status_code == 400
+
+    @patch('main.REGISTRATION_BATCH_MAX_SIZE', 2)
+    def test_batch_rejects_oversized_batch(self):
+        """Batches above REGISTRATION_BATCH_MAX_SIZE should return 400"""
+        response = self._post_batch([["user-a", "iOS"]] * 3)
+        assert response.status_code == 400
 
 
 class TestInputValidation:
@@ -194,3 +399,317 @@ class TestDatabaseInteraction:
         call_args = mock_cursor.execute.call_args
         assert "%s" in call_args[0][0]  # Query uses placeholders
         assert malicious_key.strip() in call_args[0][1]  # Actual value passed as parameter
+
+    @patch('main.get_db_connection')
+    def test_insert_notifies_statistics_pods(self, mock_db_conn):
+        """The INSERT should publish pg_notify in the same statement, before commit"""
+        mock_cursor = Mock()
+        mock_conn = Mock()
+        mock_conn.cursor.return_value = mock_cursor
+        mock_db_conn.return_value = mock_conn
+
+        response = client.post(
+            "/Device/register",
+            json={"userKey": "user123", "deviceType": "iOS"}
+        )
+
+        assert response.status_code == 200
+        query = mock_cursor.execute.call_args[0][0]
+        assert "INSERT INTO device_registrations" in query
+        assert "device_type_code(%s)" in query
+        assert "pg_notify('device_registrations', %s)" in query
+        mock_conn.commit.assert_called_once()
+
+
+class TestHeavyHitters:
+    """Tests for the Space-Saving summary and its persistence"""
+
+    def test_space_saving_counts_exactly_below_capacity(self):
+        """With fewer keys than capacity, counts should be exact"""
+        summary = SpaceSaving(10)
+        for key in ["a", "b", "a", "c", "a", "b"]:
+            summary.add(key)
+
+        assert summary.counts == {"a": 3, "b": 2, "c": 1}
+
+    def test_space_saving_memory_is_bounded(self):
+        """The summary should never track more keys than its capacity"""
+        summary = SpaceSaving(5)
+        for i in range(1000):
+            summary.add(f"user-{i}")
+
+        assert len(summary.counts) == 5
+
+    def test_space_saving_keeps_heavy_hitters(self):
+        """Frequent keys should survive a long tail of one-off keys"""
+        summary = SpaceSaving(10)
+        for i in range(2000):
+            summary.add("heavy-1")
+            if i % 2 == 0:
+                summary.add("heavy-2")
+            summary.add(f"tail-{i}")
+
+        top = sorted(summary.counts.items(), key=lambda item: -item[1])[:2]
+        assert [key for key, _ in top] == ["heavy-1", "heavy-2"]
+        # Counts are upper bounds, never under-estimates
+        assert summary.counts["heavy-1"] >= 2000
+        assert summary.counts["heavy-2"] >= 1000
+
+    @patch('main.record_heavy_hitter')
+    @patch('main.get_db_connection')
+    def test_register_records_heavy_hitter_after_commit(self, mock_db_conn, mock_record):
+        """Successful registrations should be counted with the trimmed userKey"""
+        mock_conn = Mock()
+        mock_conn.cursor.return_value = Mock()
+        mock_db_conn.return_value = mock_conn
+
+        client.post("/Device/register", json={"userKey": " user123 ", "deviceType": "TV"})
+
+        mock_record.assert_called_once_with("TV", "user123")
+
+    @patch('main.record_heavy_hitter')
+    @patch('main.get_db_connection')
+    def test_failed_register_is_not_recorded(self, mock_db_conn, mock_record):
+        """Registrations that failed to commit should not be counted"""
+        mock_db_conn.side_effect = Exception("Database error")
+
+        client.post("/Device/register", json={"userKey": "user123", "deviceType": "TV"})
+
+        mock_record.assert_not_called()
+
+    def test_merge_summaries_keeps_upper_bounds(self):
+        """A key missing from a full summary should get that summary's smallest count"""
+        left = {"a": 10, "b": 4}          # full (capacity 2): "c" may have had up to 4 here
+        right = {"c": 7}                  # not full: "a" and "b" were never seen here
+
+        assert merge_summaries(left, right, 2) == {"a": 10, "c": 11}
+        assert merge_summaries({"a": 1}, {"a": 2, "b": 1}, 5) == {"a": 3, "b": 1}
+
+    def _mock_connection(self, mock_db_conn):
+        mock_cursor = Mock()
+        mock_cursor.fetchone.return_value = None   # no stale instances
+        mock_conn = Mock()
+        mock_conn.cursor.return_value = mock_cursor
+        mock_db_conn.return_value = mock_conn
+        return mock_conn, mock_cursor
+
+    @patch('main.HEAVY_HITTERS_INSTANCE', 'pod-a-1f2e3d4c')
+    @patch('main._heavy_hitters_persisted', False)
+    @patch('main._heavy_hitters', {"iOS": SpaceSaving(10)})
+    @patch('main.execute_values')
+    @patch('main.get_db_connection')
+    def test_persist_replaces_rows_with_cumulative_counts(self, mock_db_conn, mock_execute_values):
+        """Each flush should replace this process's rows with its counts since startup"""
+        import main
+        main._heavy_hitters["iOS"].add("user123")
+        main._heavy_hitters["iOS"].add("user123")
+        mock_conn, mock_cursor = self._mock_connection(mock_db_conn)
+
+        persist_heavy_hitters()
+
+        mock_cursor.execute.assert_any_call("DELETE FROM heavy_hitters WHERE pod_name = %s", ("pod-a-1f2e3d4c",))
+        assert mock_execute_values.call_args[0][2] == [("pod-a-1f2e3d4c", "iOS", "user123", 2)]
+        mock_conn.commit.assert_called_once()
+        mock_conn.close.assert_called_once()
+
+        # The summary is kept — the next flush writes the running total
+        main._heavy_hitters["iOS"].add("user123")
+        mock_cursor.rowcount = 1
+        persist_heavy_hitters()
+        assert mock_execute_values.call_args[0][2] == [("pod-a-1f2e3d4c", "iOS", "user123", 3)]
+
+    @patch('main.execute_values')
+    @patch('main.get_db_connection')
+    def test_restarted_process_keeps_previous_rows(self, mock_db_conn, mock_execute_values):
+        """A restart under the same hostname must not delete its predecessor's rows"""
+        import main
+        _, mock_cursor = self._mock_connection(mock_db_conn)
+
+        persist_heavy_hitters()
+
+        # Rows are keyed per process, not per hostname, and a flush only
+        # deletes its own process's rows
+        assert main.HEAVY_HITTERS_INSTANCE.startswith(f"{main.POD_NAME}-")
+        assert main.HEAVY_HITTERS_INSTANCE != main.POD_NAME
+        mock_cursor.execute.assert_any_call("DELETE FROM heavy_hitters WHERE pod_name = %s", (main.HEAVY_HITTERS_INSTANCE,))
+
+    @patch('main._heavy_hitters_persisted', True)
+    @patch('main._heavy_hitters', {"TV": SpaceSaving(10)})
+    @patch('main.execute_values')
+    @patch('main.get_db_connection')
+    def test_folded_rows_are_not_written_again(self, mock_db_conn, mock_execute_values):
+        """If another pod folded this process's rows, its counts must not be written twice"""
+        import main
+        main._heavy_hitters["TV"].add("user123")
+        mock_conn, mock_cursor = self._mock_connection(mock_db_conn)
+        mock_cursor.rowcount = 0   # our rows from the last flush are gone
+
+        persist_heavy_hitters()
+
+        mock_execute_values.assert_not_called()
+        mock_conn.commit.assert_called_once()
+        assert main._heavy_hitters["TV"].counts == {}
+        assert main._heavy_hitters_persisted is False
+
+    @patch('main.HEAVY_HITTERS_CAPACITY', 2)
+    @patch('main._heavy_hitters', {})
+    @patch('main.execute_values')
+    @patch('main.get_db_connection')
+    def test_stale_instance_is_folded_into_merged(self, mock_db_conn, mock_execute_values):
+        """A whole instance that stopped flushing should be merged into "*merged*" """
+        _, mock_cursor = self._mock_connection(mock_db_conn)
+        mock_cursor.fetchone.return_value = (1,)
+        mock_cursor.fetchall.side_effect = [
+            [("pod-b-0a1b2c3d", "iOS", "user-a", 5), ("pod-b-0a1b2c3d", "iOS", "user-c", 2)],
+            [("iOS", "user-a", 3), ("iOS", "user-b", 1)],
+        ]
+
+        persist_heavy_hitters()
+
+        queries = [call[0][0] for call in mock_cursor.execute.call_args_list]
+        assert any("pg_advisory_xact_lock" in query for query in queries)
+        assert any("HAVING MAX(updated_at)" in query and "DELETE" in query for query in queries)
+        # "user-b" would have had up to 2 in the full stale summary: 1 + 2 = 3;
+        # "user-c" gets the full merged summary's floor: 2 + 1 = 3
+        merged_rows = mock_execute_values.call_args[0][2]
+        assert sorted(merged_rows)[0] == ("*merged*", "iOS", "user-a", 8)
+        assert len(merged_rows) == 2
+
+    @patch('main.get_db_connection')
+    def test_persist_rolls_back_on_error(self, mock_db_conn):
+        """A failed flush should roll back and re-raise for the caller to log"""
+        mock_cursor = Mock()
+        mock_cursor.execute.side_effect = Exception("relation does not exist")
+        mock_conn = Mock()
+        mock_conn.cursor.return_value = mock_cursor
+        mock_db_conn.return_value = mock_conn
+
+        with pytest.raises(Exception):
+            persist_heavy_hitters()
+
+        mock_conn.rollback.assert_called_once()
+        mock_conn.close.assert_called_once()
+
+
+class TestProfilingEndpoint:
+    """Tests for GET /debug/profile"""
+
+    def test_profile_disabled_by_default(self):
+        """Profiling endpoint should not exist unless explicitly enabled"""
+        response = client.get("/debug/profile?seconds=0.01", headers={"X-Admin-Token": "secret"})
+        assert response.status_code == 404
+
+    @patch('main.PROFILING_TOKEN', 'secret')
+    @patch('main.PROFILING_ENABLED', True)
+    def test_profile_rejects_wrong_token(self):
+        """Wrong admin token should return 403"""
+        response = client.get("/debug/profile?seconds=0.01", headers={"X-Admin-Token": "wrong"})
+        assert response.status_code == 403
+
+        # Non-ASCII tokens must be rejected, not crash the comparison
+        response = client.get("/debug/profile?seconds=0.01", headers={"X-Admin-Token": "sécret".encode()})
+        assert response.status_code == 403
+
+    def test_non_ascii_token_is_rejected_at_startup(self):
+        """A token the header bytes could never reliably match should stop the service"""
+        import subprocess
+        env = dict(os.environ, PROFILING_ENABLED="true", PROFILING_TOKEN="sécret")
+        result = subprocess.run(
+            [sys.executable, "-c", "import main"],
+            cwd=os.path.join(os.path.dirname(__file__), '..'), env=env, capture_output=True, text=True
+        )
+
+        assert result.returncode != 0
+        assert "PROFILING_TOKEN must be ASCII" in result.stderr
+
+    @patch('main.PROFILING_TOKEN', 'secret')
+    @patch('main.PROFILING_ENABLED', True)
+    def test_profile_returns_collapsed_stacks(self):
+        """Enabled profiler should return 'frame;frame count' lines"""
+        response = client.get("/debug/profile?seconds=0.05", headers={"X-Admin-Token": "secret"})
+
+        assert response.status_code == 200
+        for line in response.text.strip().splitlines():
+            stack, count = line.rsplit(" ", 1)
+            assert stack
+            assert int(count) > 0
+
+
+class TestSlowRequestTimer:
+    """Tests for the slow-request stage breakdown log"""
+
+    # The timer is only installed when SLOW_REQUEST_THRESHOLD_MS is set at
+    # startup, so wrap the app explicitly
+    timed_client = TestClient(SlowRequestTimer(app))
+
+    @patch('main.SLOW_REQUEST_THRESHOLD_MS', 0.001)
+    @patch('main.get_db_connection')
+    def test_slow_request_logs_stage_breakdown(self, mock_db_conn, caplog):
+        """Requests above the threshold should be logged with their stages"""
+        mock_cursor = Mock()
+        mock_conn = Mock()
+        mock_conn.cursor.return_value = mock_cursor
+        mock_db_conn.return_value = mock_conn
+
+        with caplog.at_level("WARNING", logger="device-registration-api"):
+            response = self.timed_client.post(
+                "/Device/register",
+                json={"userKey": "user123", "deviceType": "iOS"}
+            )
+
+        assert response.status_code == 200
+        assert "slow request: POST /Device/register" in caplog.text
+        assert "db_insert=" in caplog.text
+        assert "db_commit=" in caplog.text
+
+    def test_slow_request_timer_not_installed_by_default(self):
+        """With no threshold at startup the middleware should not wrap the app at all"""
+        assert SlowRequestTimer not in [middleware.cls for middleware in app.user_middleware]
+
+
+class TestSaturationMetrics:
+    """Tests for GET /metrics (saturation gauges for autoscaling)"""
+
+    def _metric(self, body: str, name: str) -> float:
+        for line in body.splitlines():
+            if line.startswith(f"{name} "):
+                return float(line.split()[1])
+        raise AssertionError(f"{name} not exported")
+
+    def test_metrics_exports_all_gauges(self):
+        """Every saturation gauge should be present in Prometheus text format"""
+        response = client.get("/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        for name in METRICS_HELP:
+            assert f"# TYPE {name} gauge" in response.text
+        assert self._metric(response.text, "db_pool_connections_max") == DB_POOL_MAX_SIZE
+        assert self._metric(response.text, "http_requests_in_flight") == 0
+
+    @patch('main.get_db_pool')
+    def test_pool_gauges_follow_borrowed_connections(self, mock_pool):
+        """Borrowing and returning a connection should move db_pool_connections_in_use"""
+        conn = get_db_connection()
+        assert self._metric(client.get("/metrics").text, "db_pool_connections_in_use") == 1
+
+        conn.close()
+        assert self._metric(client.get("/metrics").text, "db_pool_connections_in_use") == 0
+
+    @patch('main.get_db_connection')
+    def test_request_is_counted_while_in_flight(self, mock_db_conn):
+        """A registration being processed should show in http_requests_in_flight"""
+        seen = []
+        mock_cursor = Mock()
+        mock_cursor.execute.side_effect = lambda *args: seen.append(
+            self._metric(render_metrics(), "http_requests_in_flight")
+        )
+        mock_conn = Mock()
+        mock_conn.cursor.return_value = mock_cursor
+        mock_db_conn.return_value = mock_conn
+
+        response = client.post("/Device/register", json={"userKey": "user123", "deviceType": "iOS"})
+
+        assert response.status_code == 200
+        assert seen == [1]
+        assert self._metric(render_metrics(), "http_requests_in_flight") == 0
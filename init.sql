@@ -2,11 +2,26 @@
 -- PostgreSQL initialization script.
 -- This file is executed automatically when the PostgreSQL container starts for the first time.
 
+-- Device types are stored as SMALLINT codes. The APIs keep passing plain
+-- strings ('iOS', ...) through device_type_code(), which maps them here.
+-- New device types: add a WHEN to this function (codes are never reused).
+CREATE OR REPLACE FUNCTION device_type_code(name TEXT) RETURNS SMALLINT
+LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+    SELECT CASE name WHEN 'iOS' THEN 1 WHEN 'Android' THEN 2 WHEN 'Watch' THEN 3 WHEN 'TV' THEN 4 END::SMALLINT
+$$;
+
+-- Columns ordered widest fixed-width first to avoid alignment padding. With
+-- 13-character user keys (as the seeder generates) a row is 56 bytes including
+-- the 24-byte header; the old VARCHAR/SERIAL layout took 56, or 64 for
+-- 'Android' (padding before created_at). The device_type index is the same
+-- size in both layouts — 16 bytes per entry either way.
+-- BIGINT identity: a 4-byte SERIAL overflows at ~2.1 billion registrations.
+-- Existing databases: migrate with migrations/compact_device_registrations.py
 CREATE TABLE IF NOT EXISTS device_registrations (
-    id          SERIAL          PRIMARY KEY,
-    user_key    VARCHAR(255)    NOT NULL,
-    device_type VARCHAR(50)     NOT NULL,
-    created_at  TIMESTAMP       DEFAULT CURRENT_TIMESTAMP
+    id          BIGINT          GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    created_at  TIMESTAMP       DEFAULT CURRENT_TIMESTAMP,
+    device_type SMALLINT        NOT NULL,
+    user_key    VARCHAR(255)    NOT NULL
 );
 
 
@@ -15,3 +30,22 @@ CREATE TABLE IF NOT EXISTS device_registrations (
 
 CREATE INDEX IF NOT EXISTS idx_device_registrations_device_type
     ON device_registrations (device_type);
+
+
+-- Heavy-hitter summaries: approximate top user_keys per device type.
+-- Each device-registration-api process replaces its own rows with its running
+-- summary on every flush (pod_name = pod hostname + per-start suffix); processes
+-- that stop flushing are merged into pod_name '*merged*'.
+-- Size stays bounded: (live processes + 1) x 4 device types x HEAVY_HITTERS_CAPACITY rows.
+
+CREATE TABLE IF NOT EXISTS heavy_hitters (
+    pod_name    VARCHAR(255)    NOT NULL,
+    device_type VARCHAR(50)     NOT NULL,
+    user_key    VARCHAR(255)    NOT NULL,
+    count       BIGINT          NOT NULL,
+    updated_at  TIMESTAMP       DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (pod_name, device_type, user_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_heavy_hitters_device_type
+    ON heavy_hitters (device_type);
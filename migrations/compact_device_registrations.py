@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# migrations/compact_device_registrations.py
+# Online migration of device_registrations to the compact layout in init.sql:
+#
+#   id            SERIAL (4 bytes)      -> BIGINT identity
+#   device_type   VARCHAR(50)           -> SMALLINT code (see device_type_code())
+#
+# Columns are reordered so the wider id costs no padding: with 13-character
+# user keys a row is 56 bytes, where it was 56, or 64 for 'Android'. The
+# device_type index does not shrink (16 bytes per entry in both layouts).
+#
+# The APIs keep running throughout. They send device types as strings
+# through device_type_code(): 'prepare' installs it as a pass-through for the
+# old table, and 'swap' replaces it with the SMALLINT mapping in the same
+# transaction that renames the tables. Steps:
+#
+#   report    sizes + COUNT(*) latency of every device_registrations* table
+#   prepare   create the compact table and a trigger that copies new rows into it
+#             (deploy the APIs that call device_type_code() after this step)
+#   backfill  copy existing rows in id-range batches, then index + analyze
+#   swap      rename tables in one short transaction (brief lock on inserts)
+#   cleanup   drop the legacy table once you are happy with the result
+#
+#   python migrations/compact_device_registrations.py report
+#   python migrations/compact_device_registrations.py prepare
+#   python migrations/compact_device_registrations.py backfill --batch-size 50000
+#   python migrations/compact_device_registrations.py report
+#   python migrations/compact_device_registrations.py swap
+#   python migrations/compact_device_registrations.py cleanup
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import psycopg2
+from psycopg2 import sql
+
+# PostgreSQL connection parameters — same variables and defaults as the APIs
+DB_HOST     = os.getenv("DB_HOST", "localhost")
+DB_PORT     = os.getenv("DB_PORT", "5432")
+DB_NAME     = os.getenv("DB_NAME", "devicedb")
+DB_USER     = os.getenv("DB_USER", "postgres")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
+
+TABLE   = "device_registrations"
+COMPACT = "device_registrations_compact"
+LEGACY  = "device_registrations_legacy"
+
+# Same codes as device_type_code() in init.sql
+DEVICE_TYPE_CODES = {"iOS": 1, "Android": 2, "Watch": 3, "TV": 4}
+
+# ANSI color codes for output
+GREEN = '\033[92m'
+RED = '\033[91m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+
+def get_db_connection():
+    """Opens an autocommit connection with the same env vars the APIs use."""
+    conn = psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+    conn.autocommit = True
+    return conn
+
+
+def table_exists(cursor, name: str) -> bool:
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (name,))
+    return cursor.fetchone()[0]
+
+
+def create_code_function(cursor, name: str):
+    """Creates the function that maps device type names to DEVICE_TYPE_CODES."""
+    cases = sql.SQL(" ").join(
+        sql.SQL("WHEN {} THEN {}").format(sql.Literal(device_type), sql.Literal(code))
+        for device_type, code in DEVICE_TYPE_CODES.items()
+    )
+    cursor.execute(sql.SQL("""
+        CREATE OR REPLACE FUNCTION {function}(name TEXT) RETURNS SMALLINT
+        LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$
+            SELECT CASE name {cases} END::SMALLINT
+        $$
+    """).format(function=sql.Identifier(name), cases=cases))
+
+
+def column_type(cursor, table: str, column: str):
+    cursor.execute(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+        (table, column)
+    )
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+# ---------------------------------------------------------------------------
+# report
+# ---------------------------------------------------------------------------
+
+def report(cursor, runs: int):
+    """
+    Prints size and COUNT(*) latency for device_registrations and, when they
+    exist, the compact (before swap) and legacy (after swap) tables — so one
+    run shows the before/after comparison.
+    """
+    print(f"\n{'table':<30} {'rows (est.)':>14} {'table':>10} {'indexes':>10} {'total':>10} {'bytes/row':>10}")
+    tables = [name for name in (TABLE, COMPACT, LEGACY) if table_exists(cursor, name)]
+    for name in tables:
+        cursor.execute(
+            """
+            SELECT c.reltuples::bigint,
+                   pg_table_size(c.oid), pg_indexes_size(c.oid), pg_total_relation_size(c.oid)
+            FROM pg_class c WHERE c.oid = %s::regclass
+            """,
+            (name,)
+        )
+        rows, table_bytes, index_bytes, total_bytes = cursor.fetchone()
+        per_row = f"{table_bytes / rows:.1f}" if rows > 0 else "-"
+        print(f"{name:<30} {max(rows, 0):>14,} {_mb(table_bytes):>10} {_mb(index_bytes):>10} "
+              f"{_mb(total_bytes):>10} {per_row:>10}")
+
+    print(f"\nCOUNT(*) WHERE device_type = ... — median of {runs} runs (ms)")
+    print(f"{'table':<30} " + " ".join(f"{device_type:>9}" for device_type in DEVICE_TYPE_CODES))
+    for name in tables:
+        compact = column_type(cursor, name, "device_type") == "smallint"
+        medians = []
+        for device_type, code in DEVICE_TYPE_CODES.items():
+            timings = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                # Same query as GET /Log/auth/statistics
+                cursor.execute(
+                    sql.SQL("SELECT COUNT(*) FROM {} WHERE device_type = %s").format(sql.Identifier(name)),
+                    (code if compact else device_type,)
+                )
+                cursor.fetchone()
+                timings.append((time.perf_counter() - started) * 1000)
+            medians.append(statistics.median(timings))
+        print(f"{name:<30} " + " ".join(f"{ms:>9.1f}" for ms in medians))
+
+
+def _mb(size: int) -> str:
+    return f"{size / (1024 * 1024):.1f} MB"
+
+
+# ---------------------------------------------------------------------------
+# prepare
+# ---------------------------------------------------------------------------
+
+def prepare(cursor):
+    """
+    Creates the compact table and a trigger that copies every new row into
+    it. CREATE TRIGGER waits for in-flight inserts to commit, so every row
+    is either already in the table when backfill starts or copied by the
+    trigger.
+    """
+    if column_type(cursor, TABLE, "device_type") == "smallint":
+        print(f"{GREEN}✓{RESET} {TABLE} already uses the compact layout — nothing to do")
+        return
+
+    # Pass-through for the old VARCHAR column, so the APIs can call
+    # device_type_code() before and after the swap
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION device_type_code(name TEXT) RETURNS TEXT
+        LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE AS $$ SELECT name $$
+    """)
+    # The SMALLINT mapping, renamed to device_type_code by 'swap'
+    create_code_function(cursor, f"{COMPACT}_code")
+
+    # Same definition as init.sql
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {COMPACT} (
+            id          BIGINT          GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            created_at  TIMESTAMP       DEFAULT CURRENT_TIMESTAMP,
+            device_type SMALLINT        NOT NULL,
+            user_key    VARCHAR(255)    NOT NULL
+        )
+    """)
+
+    cursor.execute(sql.SQL("""
+        CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO {compact} (id, created_at, device_type, user_key)
+            VALUES (NEW.id, NEW.created_at, {code}(NEW.device_type), NEW.user_key)
+            ON CONFLICT (id) DO NOTHING;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """).format(
+        function=sql.Identifier(f"{COMPACT}_copy"),
+        compact=sql.Identifier(COMPACT),
+        code=sql.Identifier(f"{COMPACT}_code")
+    ))
+    cursor.execute(f"DROP TRIGGER IF EXISTS {COMPACT}_copy ON {TABLE}")
+    cursor.execute(f"""
+        CREATE TRIGGER {COMPACT}_copy
+        AFTER INSERT ON {TABLE}
+        FOR EACH ROW EXECUTE FUNCTION {COMPACT}_copy()
+    """)
+    print(f"{GREEN}✓{RESET} {COMPACT} created; new registrations are now written to both tables")
+
+
+# ---------------------------------------------------------------------------
+# backfill
+# ---------------------------------------------------------------------------
+
+def backfill(cursor, batch_size: int, pause: float, from_id: int):
+    """
+    Copies existing rows in id ranges of batch_size, one short transaction
+    per range (safe to re-run — already copied ids are skipped). Then builds
+    the device_type index without blocking the trigger's inserts and
+    refreshes planner statistics.
+    """
+    if not table_exists(cursor, COMPACT):
+        print(f"{RED}✗{RESET} {COMPACT} does not exist — run 'prepare' first")
+        return 1
+
+    cursor.execute(sql.SQL("SELECT COALESCE(MAX(id), 0) FROM {}").format(sql.Identifier(TABLE)))
+    max_id = cursor.fetchone()[0]
+
+    started = time.perf_counter()
+    copied = 0
+    lower = from_id
+    while lower < max_id:
+        upper = min(lower + batch_size, max_id)
+        cursor.execute(
+            sql.SQL("""
+            INSERT INTO {compact} (id, created_at, device_type, user_key)
+            SELECT id, created_at, {code}(device_type), user_key
+            FROM {table}
+            WHERE id > %s AND id <= %s
+            ON CONFLICT (id) DO NOTHING
+            """).format(
+                compact=sql.Identifier(COMPACT),
+                table=sql.Identifier(TABLE),
+                code=sql.Identifier(f"{COMPACT}_code")
+            ),
+            (lower, upper)
+        )
+        copied += cursor.rowcount
+        lower = upper
+
+        elapsed = time.perf_counter() - started
+        print(f"\r  id {lower:,}/{max_id:,} — {copied:,} rows copied ({copied / max(elapsed, 1e-9):,.0f} rows/s)",
+              end="", flush=True)
+        if pause:
+            time.sleep(pause)
+    print()
+
+    print(f"{YELLOW}Building index on {COMPACT} (device_type)...{RESET}")
+    cursor.execute(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_{COMPACT}_device_type ON {COMPACT} (device_type)"
+    )
+    cursor.execute(f"VACUUM ANALYZE {COMPACT}")
+
+    cursor.execute(
+        sql.SQL("SELECT (SELECT COUNT(*) FROM {}), (SELECT COUNT(*) FROM {})").format(
+            sql.Identifier(TABLE), sql.Identifier(COMPACT)
+        )
+    )
+    source_rows, compact_rows = cursor.fetchone()
+    if compact_rows < source_rows:
+        print(f"{RED}✗{RESET} {COMPACT} has {compact_rows:,} rows, {TABLE} has {source_rows:,} — re-run backfill")
+        return 1
+
+    print(f"{GREEN}✓{RESET} Backfill done: {compact_rows:,} rows in {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# swap
+# ---------------------------------------------------------------------------
+
+def swap(conn, lock_timeout: str):
+    """
+    Renames device_registrations -> device_registrations_legacy and
+    device_registrations_compact -> device_registrations in one transaction.
+    Inserts are blocked only for the duration of the renames; waiting
+    statements re-resolve the table name and land in the new table.
+    device_type_code() switches from the pass-through to the SMALLINT
+    mapping in the same transaction.
+    """
+    cursor = conn.cursor()
+    if not table_exists(cursor, COMPACT):
+        print(f"{RED}✗{RESET} {COMPACT} does not exist — run 'prepare' and 'backfill' first")
+        return 1
+
+    conn.autocommit = False
+    try:
+        # Give up instead of queueing behind a long-running query (and blocking everyone behind us)
+        cursor.execute("SET LOCAL lock_timeout = %s", (lock_timeout,))
+        cursor.execute(f"LOCK TABLE {TABLE}, {COMPACT} IN ACCESS EXCLUSIVE MODE")
+
+        cursor.execute(
+            sql.SQL("SELECT (SELECT COALESCE(MAX(id), 0) FROM {}), (SELECT COALESCE(MAX(id), 0) FROM {})").format(
+                sql.Identifier(TABLE), sql.Identifier(COMPACT)
+            )
+        )
+        source_max, compact_max = cursor.fetchone()
+        if compact_max < source_max:
+            raise RuntimeError(f"{COMPACT} is behind (max id {compact_max} < {source_max}) — re-run backfill")
+
+        cursor.execute(f"DROP TRIGGER {COMPACT}_copy ON {TABLE}")
+
+        cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {LEGACY}")
+        cursor.execute(f"ALTER INDEX {TABLE}_pkey RENAME TO {LEGACY}_pkey")
+        cursor.execute(f"ALTER INDEX IF EXISTS idx_{TABLE}_device_type RENAME TO idx_{LEGACY}_device_type")
+        cursor.execute(f"ALTER SEQUENCE IF EXISTS {TABLE}_id_seq RENAME TO {LEGACY}_id_seq")
+
+        cursor.execute(f"ALTER TABLE {COMPACT} RENAME TO {TABLE}")
+        cursor.execute(f"ALTER INDEX {COMPACT}_pkey RENAME TO {TABLE}_pkey")
+        cursor.execute(f"ALTER INDEX idx_{COMPACT}_device_type RENAME TO idx_{TABLE}_device_type")
+        cursor.execute(f"ALTER SEQUENCE {COMPACT}_id_seq RENAME TO {TABLE}_id_seq")
+
+        cursor.execute("DROP FUNCTION device_type_code(TEXT)")
+        cursor.execute(f"ALTER FUNCTION {COMPACT}_code(TEXT) RENAME TO device_type_code")
+
+        # Rows were copied with their original ids — continue after the highest one
+        cursor.execute(
+            sql.SQL("SELECT setval(pg_get_serial_sequence(%s, 'id'), (SELECT COALESCE(MAX(id), 0) + 1 FROM {}), false)")
+            .format(sql.Identifier(TABLE)),
+            (TABLE,)
+        )
+
+        conn.commit()
+
+    except Exception as e:
+        conn.rollback()
+        print(f"{RED}✗{RESET} Swap aborted, nothing changed: {e}")
+        return 1
+
+    finally:
+        conn.autocommit = True
+
+    print(f"{GREEN}✓{RESET} {TABLE} now uses the compact layout; old data kept in {LEGACY}")
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# cleanup
+# ---------------------------------------------------------------------------
+
+def cleanup(cursor):
+    """Drops the legacy table and the copy function once the swap is verified."""
+    cursor.execute(f"DROP TABLE IF EXISTS {LEGACY}")
+    cursor.execute(f"DROP FUNCTION IF EXISTS {COMPACT}_copy()")
+    print(f"{GREEN}✓{RESET} {LEGACY} dropped")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Online migration of device_registrations to the compact layout")
+    steps = parser.add_subparsers(dest="step", required=True)
+
+    report_parser = steps.add_parser("report", help="table/index size and COUNT(*) latency")
+    report_parser.add_argument("--runs", type=int, default=5, help="timed runs per query (default: 5)")
+
+    steps.add_parser("prepare", help="create the compact table and the dual-write trigger")
+
+    backfill_parser = steps.add_parser("backfill", help="copy existing rows in batches")
+    backfill_parser.add_argument("--batch-size", type=int, default=50_000, help="ids per transaction")
+    backfill_parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    backfill_parser.add_argument("--from-id", type=int, default=0, help="resume after this id")
+
+    swap_parser = steps.add_parser("swap", help="rename the compact table into place")
+    swap_parser.add_argument("--lock-timeout", default="5s", help="give up if the lock is not granted in time")
+
+    steps.add_parser("cleanup", help="drop the legacy table")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        if args.step == "report":
+            report(cursor, args.runs)
+        elif args.step == "prepare":
+            prepare(cursor)
+        elif args.step == "backfill":
+            return backfill(cursor, args.batch_size, args.pause, args.from_id)
+        elif args.step == "swap":
+            return swap(conn, args.lock_timeout)
+        elif args.step == "cleanup":
+            cleanup(cursor)
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
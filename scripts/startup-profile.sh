@@ -0,0 +1,51 @@
+#!/bin/bash
+# Import-time profile of both APIs, measured inside their Docker images
+# (same Python, same precompiled bytecode as production).
+# Fails when a service's import time exceeds the startup budget.
+#
+# Usage: ./scripts/startup-profile.sh
+#        STARTUP_IMPORT_BUDGET_MS=800 TOP=20 ./scripts/startup-profile.sh
+
+set -e
+
+RED='\033[0;31m'
+GREEN='\033[0;32m'
+BLUE='\033[0;34m'
+NC='\033[0m'
+
+PROJECT_ROOT="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)"
+cd "$PROJECT_ROOT"
+
+# Budget for "import main" — everything that runs before uvicorn can start
+# the lifespan warm-up (DB pool + HTTP client, reported by GET /ready)
+BUDGET_MS="${STARTUP_IMPORT_BUDGET_MS:-1500}"
+TOP="${TOP:-10}"
+
+FAILED=0
+
+for SERVICE in statistics-api device-registration-api; do
+    echo -e "${BLUE}━━━ ${SERVICE} ━━━${NC}"
+    docker build -q -t "${SERVICE}:startup-profile" "./${SERVICE}" > /dev/null
+
+    # -X importtime writes "self [us] | cumulative [us] | module" to stderr.
+    # The second run is the one that counts: the first one warms the page cache.
+    docker run --rm --entrypoint python "${SERVICE}:startup-profile" -c "import main" 2> /dev/null
+    PROFILE=$(docker run --rm --entrypoint python "${SERVICE}:startup-profile" \
+        -X importtime -c "import main" 2>&1 >/dev/null | grep '^import time:' | grep -v 'self \[us\]')
+
+    echo "Top ${TOP} imports by cumulative time (ms):"
+    echo "$PROFILE" \
+        | awk -F'|' '{ gsub(/ /, "", $2); printf "%10.1f  %s\n", $2 / 1000, $3 }' \
+        | sort -rn | head -n "$TOP"
+
+    TOTAL_MS=$(echo "$PROFILE" | awk -F'|' '$3 ~ /^ main$/ { gsub(/ /, "", $2); printf "%d", $2 / 1000 }')
+    if [ "$TOTAL_MS" -le "$BUDGET_MS" ]; then
+        echo -e "${GREEN}✓ import main: ${TOTAL_MS}ms (budget ${BUDGET_MS}ms)${NC}"
+    else
+        echo -e "${RED}✗ import main: ${TOTAL_MS}ms exceeds budget ${BUDGET_MS}ms${NC}"
+        FAILED=$((FAILED + 1))
+    fi
+    echo ""
+done
+
+exit $FAILED
@@ -2,22 +2,59 @@
 # This service is the entry point for external traffic.
 # It calls the Device Registration API internally to persist data.
 
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import JSONResponse
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from fastapi import FastAPI, Header, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+from psycopg2.pool import ThreadedConnectionPool
 from pydantic import BaseModel
 import httpx
 import psycopg2
+import asyncio
+import logging
 import os
+import select
+import sys
+import threading
+import time
 
 # ---------------------------------------------------------------------------
 # App initialization
 # ---------------------------------------------------------------------------
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Warms the pod up before uvicorn starts accepting traffic (DB pool and
+    HTTP client, see warm_up below) and releases both on shutdown.
+    A failed warm-up does not stop the pod — /ready retries it.
+
+    Also starts the registration listener that keeps this pod's statistics
+    cache in sync with the other pods (see listen_for_registrations), and
+    the event-loop lag probe behind GET /metrics.
+    """
+    await warm_up()
+    start_registration_listener()
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    yield
+    lag_monitor.cancel()
+    stop_registration_listener()
+    if _registration_batcher is not None:
+        await _registration_batcher.drain()
+    if _http_client is not None:
+        await _http_client.aclose()
+    if _db_pool is not None:
+        _db_pool.closeall()
+
+
 # Create the FastAPI app with metadata shown in the auto-generated /docs page
 app = FastAPI(
     title="Statistics API",
     description="Public API for logging authentication events and retrieving device statistics",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # ---------------------------------------------------------------------------
@@ -27,6 +64,14 @@ app = FastAPI(
 # URL of the internal Device Registration API (set in docker-compose / K8s)
 DEVICE_API_URL = os.getenv("DEVICE_API_URL", "http://localhost:8001")
 
+# How POST /Log/auth reaches the Device Registration API:
+#   "json"    — one JSON POST /Device/register per event (default)
+#   "msgpack" — concurrent events coalesced into msgpack POST /Device/register/batch
+# Deploy the Device Registration API with the batch endpoint before switching.
+DEVICE_API_PROTOCOL          = os.getenv("DEVICE_API_PROTOCOL", "json")
+DEVICE_API_BATCH_MAX_SIZE    = int(os.getenv("DEVICE_API_BATCH_MAX_SIZE", "64"))
+DEVICE_API_BATCH_MAX_WAIT_MS = float(os.getenv("DEVICE_API_BATCH_MAX_WAIT_MS", "2"))
+
 # PostgreSQL connection parameters — used for the statistics query
 DB_HOST     = os.getenv("DB_HOST", "localhost")
 DB_PORT     = os.getenv("DB_PORT", "5432")
@@ -34,6 +79,51 @@ DB_NAME     = os.getenv("DB_NAME", "devicedb")
 DB_USER     = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
 
+# Connection pool — MIN connections are opened at startup, up to MAX are
+# opened on demand and then kept open; callers wait up to TIMEOUT seconds for one
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT  = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+
+# Seconds to wait for a new database connection before giving up
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+
+# On-demand profiling — disabled by default, and even when enabled every call
+# must present PROFILING_TOKEN in the X-Admin-Token header
+PROFILING_ENABLED            = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILING_TOKEN              = os.getenv("PROFILING_TOKEN", "")
+PROFILING_MAX_SECONDS        = 60
+PROFILING_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILING_SAMPLE_INTERVAL_MS", "5"))
+
+# The token is compared with the raw header bytes, and how non-ASCII text
+# becomes bytes depends on the client — only ASCII tokens can match reliably
+if PROFILING_ENABLED and not PROFILING_TOKEN.isascii():
+    raise RuntimeError("PROFILING_TOKEN must be ASCII")
+
+# How long (seconds) clients and this pod may reuse a statistics result.
+# Sent as Cache-Control max-age; 0 disables the per-pod cache as well.
+STATISTICS_CACHE_MAX_AGE = int(os.getenv("STATISTICS_CACHE_MAX_AGE", "5"))
+
+# Cross-pod invalidation — the Device Registration API sends a NOTIFY on this
+# channel (payload: the device type) for every committed registration.
+# While this pod is listening, its cached counts stay valid until notified,
+# up to STATISTICS_NOTIFY_MAX_AGE seconds — a safety net for rows written outside the APIs.
+STATISTICS_NOTIFY_ENABLED = os.getenv("STATISTICS_NOTIFY_ENABLED", "true").lower() == "true"
+STATISTICS_NOTIFY_CHANNEL = "device_registrations"
+STATISTICS_NOTIFY_MAX_AGE = int(os.getenv("STATISTICS_NOTIFY_MAX_AGE", "60"))
+
+# Upper bound for ?limit= on the top users endpoint — the registration API
+# tracks HEAVY_HITTERS_CAPACITY (default 1000) users per device type per pod
+TOP_USERS_MAX_LIMIT = 100
+
+# Requests slower than this are logged with a per-stage breakdown (0 = off)
+SLOW_REQUEST_THRESHOLD_MS = float(os.getenv("SLOW_REQUEST_THRESHOLD_MS", "0"))
+
+# How often (seconds) the event-loop lag reported by GET /metrics is measured
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+logger = logging.getLogger("statistics-api")
+
 # ---------------------------------------------------------------------------
 # Valid device types — used for input validation on every endpoint
 # ---------------------------------------------------------------------------
@@ -50,23 +140,670 @@ class AuthLogRequest(BaseModel):
     deviceType: str
 
 # ---------------------------------------------------------------------------
-# Helper: database connection
+# Helper: database connection pool
 # ---------------------------------------------------------------------------
 
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+# One slot per pooled connection — ThreadedConnectionPool raises instead of
+# waiting when it is exhausted, so callers queue on this semaphore first
+_db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+
+
+class KeepAliveConnectionPool(ThreadedConnectionPool):
+    """
+    ThreadedConnectionPool that keeps every returned connection open.
+    The stock pool keeps only minconn idle and closes the rest in putconn,
+    so under any real concurrency most requests would reconnect anyway.
+    minconn still decides how many connections are opened up front.
+    """
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        # putconn keeps up to self.minconn idle connections — let it keep all of them
+        self.minconn = maxconn
+
+    def discard_idle(self):
+        """Closes every idle connection, e.g. after the server dropped one of them."""
+        with self._lock:
+            while self._pool:
+                self._pool.pop().close()
+
+
+class PooledConnection:
+    """
+    A pooled psycopg2 connection that behaves like a plain one, except that
+    close() hands it back to the pool (rolling back any open transaction)
+    instead of closing the socket. Endpoints keep the usual
+    open / finally-close shape.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+        self.commit_sent = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def commit(self):
+        self.commit_sent = True
+        self._conn.commit()
+
+    def close(self):
+        if self._conn is not None:
+            # A connection the server dropped is closed instead of pooled
+            self._pool.putconn(self._conn, close=bool(self._conn.closed))
+            self._conn = None
+            _db_pool_slots.release()
+            adjust_gauge("db_pool_connections_in_use", -1)
+
+
+def get_db_pool():
+    """
+    Returns the connection pool, creating it on first use. Creating the
+    pool opens DB_POOL_MIN_SIZE connections, so this raises if the
+    database is unreachable.
+    """
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = KeepAliveConnectionPool(
+                    DB_POOL_MIN_SIZE,
+                    DB_POOL_MAX_SIZE,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    dbname=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    connect_timeout=DB_CONNECT_TIMEOUT,
+                    # Notice a silently dropped connection while it sits idle in the pool
+                    keepalives=1,
+                    keepalives_idle=30,
+                    keepalives_interval=10,
+                    keepalives_count=3
+                )
+    return _db_pool
+
+
 def get_db_connection():
     """
-    Opens a new database connection using the env vars.
-    We open one per request and close it in the finally block
-    to avoid holding idle connections.
+    Borrows a connection from the pool, waiting up to DB_POOL_TIMEOUT
+    seconds when all of them are in use. Call close() in the finally
+    block as before — it returns the connection to the pool.
+    """
+    with track_gauge("db_pool_waiting_requests"):
+        acquired = _db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT)
+    if not acquired:
+        raise TimeoutError("database connection pool exhausted")
+
+    try:
+        pool = get_db_pool()
+        conn = PooledConnection(pool, pool.getconn())
+    except Exception:
+        _db_pool_slots.release()
+        raise
+
+    adjust_gauge("db_pool_connections_in_use", 1)
+    return conn
+
+
+def with_db_connection(work):
+    """
+    Runs work(conn) on a pooled connection and returns its result.
+
+    When PostgreSQL restarts or moves, every pooled connection is dead and
+    fails on first use. If that happens here, the connection and all idle
+    ones are discarded and work runs once more on a freshly opened
+    connection — unless it already sent COMMIT, which may have been applied.
+    Any other error rolls the transaction back and is raised.
+    """
+    for attempt in range(2):
+        conn = get_db_connection()
+        try:
+            mark_stage("db_connect")
+            return work(conn)
+        except Exception as e:
+            lost = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)) and conn.closed
+            if not lost:
+                conn.rollback()
+                raise
+            if attempt or conn.commit_sent:
+                raise
+            logger.warning("database connection lost (%s), reconnecting", e.__class__.__name__)
+            get_db_pool().discard_idle()
+        finally:
+            conn.close()
+
+# ---------------------------------------------------------------------------
+# Helper: saturation metrics (GET /metrics)
+# ---------------------------------------------------------------------------
+
+# Current value of each saturation gauge — how much work is queued or in
+# progress right now. CPU stays low while requests wait on PostgreSQL or
+# the Device Registration API; these gauges don't.
+_gauges = Counter()
+_gauges_lock = threading.Lock()
+
+# Last measured event-loop lag in seconds (see monitor_event_loop_lag)
+_event_loop_lag = 0.0
+
+METRICS_HELP = {
+    "http_requests_in_flight":    "Requests currently being handled (probes and /metrics excluded)",
+    "db_pool_connections_in_use": "Pooled database connections currently borrowed",
+    "db_pool_connections_max":    "Size limit of the database connection pool (DB_POOL_MAX_SIZE)",
+    "db_pool_waiting_requests":   "Callers waiting for a pooled database connection",
+    "downstream_pending_calls":   "Registrations waiting on the Device Registration API",
+    "event_loop_lag_seconds":     "How late the event loop ran a timer at the last check",
+}
+
+
+def adjust_gauge(name: str, delta: int):
+    """Moves a gauge up or down — threadpool workers and the event loop both call this."""
+    with _gauges_lock:
+        _gauges[name] += delta
+
+
+@contextmanager
+def track_gauge(name: str):
+    """Counts the enclosed block in the named gauge while it runs."""
+    adjust_gauge(name, 1)
+    try:
+        yield
+    finally:
+        adjust_gauge(name, -1)
+
+
+async def monitor_event_loop_lag():
+    """
+    Sleeps EVENT_LOOP_LAG_INTERVAL at a time and records how much later
+    than requested it woke up — time the loop spent busy with other work
+    instead of serving requests.
+    """
+    global _event_loop_lag
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        _event_loop_lag = max(0.0, loop.time() - started - EVENT_LOOP_LAG_INTERVAL)
+
+
+def render_metrics() -> str:
+    """Renders the saturation metrics in the Prometheus text exposition format."""
+    with _gauges_lock:
+        values = dict(_gauges)
+    values["db_pool_connections_max"] = DB_POOL_MAX_SIZE
+    values["event_loop_lag_seconds"] = round(_event_loop_lag, 6)
+
+    lines = []
+    for name, help_text in METRICS_HELP.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {values.get(name, 0)}")
+    return "\n".join(lines) + "\n"
+
+# ---------------------------------------------------------------------------
+# Helper: Device Registration API client
+# ---------------------------------------------------------------------------
+
+_http_client = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Returns the shared HTTP client for the Device Registration API.
+    One client per process keeps connections alive between requests
+    instead of paying a TCP handshake on every POST /Log/auth.
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=5.0,  # fail fast if the internal service is slow
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        )
+    return _http_client
+
+class RegistrationBatcher:
+    """
+    Compact transport for POST /Log/auth (DEVICE_API_PROTOCOL=msgpack).
+
+    Concurrent submit() calls are coalesced into one msgpack
+    POST /Device/register/batch. A batch is sent when it reaches max_size
+    items or max_wait_ms after its first item, whichever comes first.
+    Batches don't wait for each other — several can be in flight at once
+    over the shared keep-alive client.
+    """
+
+    def __init__(self, max_size: int, max_wait_ms: float):
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000
+        self._pending = []        # [((userKey, deviceType), future), ...]
+        self._flush_timer = None
+        self._in_flight = set()
+
+    async def submit(self, user_key: str, device_type: str) -> int:
+        """Queues one registration and returns its status code (200 = saved)."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((user_key, device_type), future))
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._flush_timer is None:
+            self._flush_timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    async def drain(self):
+        """Sends whatever is queued and waits for all batches in flight (shutdown)."""
+        self._flush()
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+    def _flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._send(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, batch: list):
+        import msgpack  # only loaded when the compact transport is in use
+
+        try:
+            response = await get_http_client().post(
+                f"{DEVICE_API_URL}/Device/register/batch",
+                content=msgpack.packb([item for item, _ in batch]),
+                headers={"Content-Type": "application/msgpack"}
+            )
+            statuses = msgpack.unpackb(response.content) if response.status_code == 200 else None
+        except Exception as e:
+            statuses = None
+
+        # Anything but one status per item fails the whole batch
+        if not isinstance(statuses, list) or len(statuses) != len(batch):
+            statuses = [502] * len(batch)
+
+        for (_, future), status in zip(batch, statuses):
+            if not future.done():  # the caller may have gone away
+                future.set_result(status)
+
+
+_registration_batcher = None
+
+
+def get_registration_batcher() -> RegistrationBatcher:
+    """Returns the process-wide batcher, creating it on first use."""
+    global _registration_batcher
+    if _registration_batcher is None:
+        _registration_batcher = RegistrationBatcher(DEVICE_API_BATCH_MAX_SIZE, DEVICE_API_BATCH_MAX_WAIT_MS)
+    return _registration_batcher
+
+# ---------------------------------------------------------------------------
+# Helper: warm-up (startup + readiness)
+# ---------------------------------------------------------------------------
+
+# Set once the DB pool is open — /ready reports 503 until then, so
+# Kubernetes never routes traffic to a cold pod
+_warm = False
+_warmup_ms = None
+
+# The warm-up attempt in progress, shared by everyone who asks meanwhile
+_warmup_attempt = None
+
+
+async def warm_up() -> bool:
+    """
+    Runs a warm-up attempt, or waits for the one already in progress.
+    While the database is down every /ready probe ends up here; sharing one
+    attempt keeps them from piling up threadpool threads (and starving
+    /health) behind a slow connect.
+    """
+    global _warmup_attempt
+    if _warmup_attempt is None:
+        _warmup_attempt = asyncio.ensure_future(_attempt_warm_up())
+        _warmup_attempt.add_done_callback(_clear_warmup_attempt)
+    # shield: a probe that times out must not cancel the attempt for the others
+    return await asyncio.shield(_warmup_attempt)
+
+
+def _clear_warmup_attempt(attempt):
+    global _warmup_attempt
+    if _warmup_attempt is attempt:
+        _warmup_attempt = None
+
+
+async def _attempt_warm_up() -> bool:
+    """
+    Opens the DB pool (DB_POOL_MIN_SIZE connections, each bounded by
+    DB_CONNECT_TIMEOUT) and, best effort, a keep-alive connection to the
+    Device Registration API. Only the database gates readiness: GET
+    statistics must keep working even when the internal service is down.
+    """
+    global _warm, _warmup_ms
+    started = time.perf_counter()
+
+    try:
+        await run_in_threadpool(get_db_pool)
+    except Exception as e:
+        logger.warning("warm-up: database not reachable yet (%s)", e.__class__.__name__)
+        return False
+
+    try:
+        await get_http_client().get(f"{DEVICE_API_URL}/health", timeout=2.0)
+    except httpx.HTTPError as e:
+        logger.warning("warm-up: device registration API not reachable (%s)", e.__class__.__name__)
+
+    _warmup_ms = round((time.perf_counter() - started) * 1000, 1)
+    _warm = True
+    return True
+
+# ---------------------------------------------------------------------------
+# Helper: statistics cache + HTTP caching headers
+# ---------------------------------------------------------------------------
+
+# Last count read per device type: {deviceType: (count, time.monotonic() of the read)}.
+# The table is append-only, so the count doubles as the version of the
+# result — it only changes when a registration lands.
+_statistics_cache = {}
+
+# Bumped on every invalidation — a count read from the database is only
+# cached if no invalidation for its device type arrived while it was read
+_statistics_versions = Counter()
+_statistics_cache_lock = threading.Lock()
+
+
+def get_cached_count(device_type: str):
+    """
+    Returns the cached count for a device type if it is still fresh,
+    otherwise None (caller must hit the database). Fresh means younger than
+    STATISTICS_CACHE_MAX_AGE, or STATISTICS_NOTIFY_MAX_AGE while the
+    registration listener is connected. A max age of 0 disables the cache.
+    """
+    if STATISTICS_CACHE_MAX_AGE <= 0:
+        return None
+
+    entry = _statistics_cache.get(device_type)
+    if entry is None:
+        return None
+
+    count, read_at = entry
+    max_age = STATISTICS_NOTIFY_MAX_AGE if _listener_connected else STATISTICS_CACHE_MAX_AGE
+    if time.monotonic() - read_at >= max_age:
+        return None
+    return count
+
+
+def cache_count(device_type: str, count: int, version: int):
+    """
+    Caches a count read from the database, unless the device type was
+    invalidated since the read started (version is _statistics_versions
+    at that time) — the count may then predate the new registration.
     """
-    return psycopg2.connect(
-        host=DB_HOST,
-        port=DB_PORT,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD
+    with _statistics_cache_lock:
+        if _statistics_versions[device_type] == version:
+            _statistics_cache[device_type] = (count, time.monotonic())
+
+
+def invalidate_statistics(device_type: str = None):
+    """
+    Drops the cached count of one device type, or of all of them when
+    device_type is None or unknown.
+    """
+    with _statistics_cache_lock:
+        device_types = [device_type] if device_type in VALID_DEVICE_TYPES else VALID_DEVICE_TYPES
+        for name in device_types:
+            _statistics_cache.pop(name, None)
+            _statistics_versions[name] += 1
+
+
+def statistics_etag(device_type: str, count: int) -> str:
+    """Strong ETag for a statistics result, derived from the count version."""
+    return f'"{device_type}-{count}"'
+
+
+def etag_matches(if_none_match, etag: str) -> bool:
+    """
+    Checks an If-None-Match header against our ETag. Accepts "*", lists of
+    tags, and weak tags (W/"...") — per RFC 9110, If-None-Match uses weak
+    comparison.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        tag.strip().removeprefix("W/") == etag
+        for tag in if_none_match.split(",")
+    )
+
+
+def statistics_error(device_type: str):
+    """Error body for the statistics endpoint — never cached downstream."""
+    return JSONResponse(
+        content={"deviceType": device_type, "count": -1},
+        headers={"Cache-Control": "no-store"}
     )
 
+# ---------------------------------------------------------------------------
+# Helper: cross-pod cache invalidation (PostgreSQL LISTEN/NOTIFY)
+# ---------------------------------------------------------------------------
+
+# True while the listener holds a working LISTEN connection — only then are
+# cached counts kept beyond STATISTICS_CACHE_MAX_AGE
+_listener_connected = False
+_listener_stop = threading.Event()
+_listener_thread = None
+
+
+def listen_for_registrations():
+    """
+    Listener thread: keeps a dedicated autocommit connection (outside the
+    pool) subscribed to STATISTICS_NOTIFY_CHANNEL and invalidates the
+    cached count named by each notification. Reconnects with backoff when
+    the connection drops; everything cached is invalidated on (re)connect,
+    since notifications sent while disconnected are lost.
+    """
+    global _listener_connected
+    backoff = 1
+
+    while not _listener_stop.is_set():
+        conn = None
+        try:
+            conn = psycopg2.connect(
+                host=DB_HOST,
+                port=DB_PORT,
+                dbname=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                connect_timeout=DB_CONNECT_TIMEOUT,
+                # Detect a silently dropped connection instead of waiting forever
+                keepalives=1,
+                keepalives_idle=30,
+                keepalives_interval=10,
+                keepalives_count=3
+            )
+            conn.autocommit = True
+            conn.cursor().execute(f"LISTEN {STATISTICS_NOTIFY_CHANNEL}")
+
+            invalidate_statistics()
+            _listener_connected = True
+            backoff = 1
+
+            while not _listener_stop.is_set():
+                # Wake up at least once a second to notice shutdown
+                select.select([conn], [], [], 1.0)
+                conn.poll()
+                while conn.notifies:
+                    invalidate_statistics(conn.notifies.pop(0).payload)
+
+        except Exception as e:
+            logger.warning("registration listener: connection lost (%s), retrying in %ds",
+                           e.__class__.__name__, backoff)
+
+        finally:
+            _listener_connected = False
+            if conn is not None:
+                conn.close()
+
+        _listener_stop.wait(backoff)
+        backoff = min(backoff * 2, 30)
+
+
+def start_registration_listener():
+    """Starts the listener thread (once) when STATISTICS_NOTIFY_ENABLED."""
+    global _listener_thread
+    if STATISTICS_NOTIFY_ENABLED and _listener_thread is None:
+        _listener_stop.clear()
+        _listener_thread = threading.Thread(
+            target=listen_for_registrations, name="registration-listener", daemon=True
+        )
+        _listener_thread.start()
+
+
+def stop_registration_listener():
+    """Stops the listener thread and waits for it to close its connection."""
+    global _listener_thread
+    if _listener_thread is not None:
+        _listener_stop.set()
+        _listener_thread.join(timeout=5)
+        _listener_thread = None
+
+# ---------------------------------------------------------------------------
+# Helper: diagnostics (sampling profiler + slow-request timer)
+# ---------------------------------------------------------------------------
+
+# Only one profile may run at a time — two samplers would skew each other
+_profiling_lock = threading.Lock()
+
+# Stage marks of the current request, set by the slow-request middleware.
+# None means the timer is off and mark_stage() does nothing.
+_request_stages: ContextVar = ContextVar("request_stages", default=None)
+
+
+def collect_stack_samples(seconds: float, interval_ms: float) -> str:
+    """
+    Samples the stack of every thread in the process (except the sampler)
+    for the given number of seconds and returns them in collapsed-stack
+    format — one "outer;...;inner count" line per distinct stack — which
+    flamegraph.pl and speedscope read directly.
+
+    This is a wall-clock profiler: idle threadpool workers show up waiting
+    in threading.py, and the event loop shows up in select() when idle.
+    """
+    samples = Counter()
+    sampler_id = threading.get_ident()
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == sampler_id:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            samples[";".join(reversed(stack))] += 1
+        time.sleep(interval_ms / 1000)
+
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+def mark_stage(name: str):
+    """
+    Records that the named stage of the current request just finished.
+    The slow-request middleware turns the marks into a per-stage breakdown.
+    """
+    stages = _request_stages.get()
+    if stages is not None:
+        stages.append((name, time.perf_counter()))
+
+# ---------------------------------------------------------------------------
+# Middleware
+# ---------------------------------------------------------------------------
+
+# Not counted as in-flight work — probes and scrapes would only add noise
+UNTRACKED_PATHS = {"/health", "/ready", "/metrics"}
+
+
+class InFlightTracker:
+    """
+    Counts requests in progress for the http_requests_in_flight gauge.
+    Plain ASGI middleware, like SlowRequestTimer below.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in UNTRACKED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        with track_gauge("http_requests_in_flight"):
+            await self.app(scope, receive, send)
+
+
+app.add_middleware(InFlightTracker)
+
+
+class SlowRequestTimer:
+    """
+    Logs requests slower than SLOW_REQUEST_THRESHOLD_MS together with the
+    time spent in each stage marked by the endpoint (see mark_stage).
+
+    Plain ASGI middleware, and only installed when the threshold is set —
+    a BaseHTTPMiddleware layer costs every request even when it does nothing.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or SLOW_REQUEST_THRESHOLD_MS <= 0:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        stages = []
+        status_code = 500  # if the app fails before sending a response
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        token = _request_stages.set(stages)
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _request_stages.reset(token)
+            end = time.perf_counter()
+
+            elapsed_ms = (end - start) * 1000
+            if elapsed_ms >= SLOW_REQUEST_THRESHOLD_MS:
+                breakdown = []
+                previous = start
+                for name, at in stages + [("rest", end)]:
+                    breakdown.append(f"{name}={(at - previous) * 1000:.1f}ms")
+                    previous = at
+                logger.warning(
+                    "slow request: %s %s %.1fms (status %d) %s",
+                    scope["method"], scope["path"], elapsed_ms,
+                    status_code, " ".join(breakdown)
+                )
+
+
+if SLOW_REQUEST_THRESHOLD_MS > 0:
+    app.add_middleware(SlowRequestTimer)
+
 # ---------------------------------------------------------------------------
 # Endpoints
 # ---------------------------------------------------------------------------
@@ -79,6 +816,32 @@ def health_check():
     return {"status": "ok", "service": "statistics-api"}
 
 
+@app.get("/ready")
+async def readiness_check():
+    """
+    Readiness probe. Returns 503 until the pod is warm (DB pool open),
+    retrying the warm-up on each call, so traffic never lands on a cold pod.
+    /health stays a pure liveness check.
+    """
+    if not _warm and not await warm_up():
+        return JSONResponse(
+            status_code=503,
+            content={"status": "warming_up", "service": "statistics-api"}
+        )
+    return {"status": "ready", "service": "statistics-api", "warmupMs": _warmup_ms}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Saturation gauges in Prometheus text format, for custom-metrics
+    autoscaling (see k8s/statistics-api/hpa.yaml). Async on purpose: a
+    scrape must not queue behind a full threadpool. The public ALB does
+    not route this path.
+    """
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
 @app.post("/Log/auth")
 async def log_auth(request: AuthLogRequest):
     """
@@ -96,22 +859,33 @@ async def log_auth(request: AuthLogRequest):
             status_code=400,
             content={"statusCode": 400, "message": "bad_request"}
         )
+    mark_stage("validate")
 
     try:
-        # httpx is an async HTTP client — forwards the request to the internal service
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{DEVICE_API_URL}/Device/register",
-                json={"userKey": request.userKey, "deviceType": request.deviceType},
-                timeout=5.0  # fail fast if the internal service is slow
-            )
+        with track_gauge("downstream_pending_calls"):
+            if DEVICE_API_PROTOCOL == "msgpack":
+                # Compact transport — coalesced with concurrent events into one msgpack batch
+                status_code = await get_registration_batcher().submit(request.userKey, request.deviceType)
+            else:
+                # Shared async HTTP client — reuses keep-alive connections to the internal service
+                response = await get_http_client().post(
+                    f"{DEVICE_API_URL}/Device/register",
+                    json={"userKey": request.userKey, "deviceType": request.deviceType}
+                )
+                status_code = response.status_code
+        mark_stage("device_api")
 
-        if response.status_code != 200:
+        if status_code != 200:
             return JSONResponse(
                 status_code=400,
                 content={"statusCode": 400, "message": "bad_request"}
             )
 
+        # This pod's cached count is now behind — drop it right away so the
+        # next read here sees the new registration (other pods hear about it
+        # through the registration listener)
+        invalidate_statistics(request.deviceType)
+
         return {"statusCode": 200, "message": "success"}
 
     except httpx.RequestError:
@@ -129,35 +903,156 @@ async def log_auth(request: AuthLogRequest):
 
 
 @app.get("/Log/auth/statistics")
-def get_statistics(deviceType: str = Query(..., description="Device type to filter by")):
+def get_statistics(
+    deviceType: str = Query(..., description="Device type to filter by"),
+    if_none_match: str = Header(None)
+):
     """
     Returns how many times a device type was registered.
     Expects a deviceType query param (iOS, Android, Watch or TV).
 
+    Successful responses carry an ETag and a Cache-Control max-age so the
+    ALB, CDN and browsers can absorb repeated reads. While this pod's
+    cached count is fresh, both the body and the 304 are served without
+    touching the database.
+
     Returns:
         200 — {"deviceType": "...", "count": N} on success
         200 — {"deviceType": "...", "count": -1} on error (invalid type or DB error)
+        304 — If-None-Match matches the current ETag (no body)
     """
     if deviceType not in VALID_DEVICE_TYPES:
-        return {"deviceType": deviceType, "count": -1}
+        return statistics_error(deviceType)
 
-    conn = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+    count = get_cached_count(deviceType)
+
+    if count is None:
+        version = _statistics_versions[deviceType]
+
+        def count_registrations(conn):
+            cursor = conn.cursor()
+
+            # Parameterized query — %s placeholder prevents SQL injection.
+            # device_type_code() maps the name to the stored SMALLINT (see init.sql).
+            cursor.execute(
+                "SELECT COUNT(*) FROM device_registrations WHERE device_type = device_type_code(%s)",
+                (deviceType,)
+            )
+            return cursor.fetchone()[0]
+
+        try:
+            count = with_db_connection(count_registrations)
+            mark_stage("db_query")
+
+            cache_count(deviceType, count, version)
+
+        except Exception as e:
+            return statistics_error(deviceType)
+
+    etag = statistics_etag(deviceType, count)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={STATISTICS_CACHE_MAX_AGE}"
+    }
 
-        # Parameterized query — %s placeholder prevents SQL injection
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse(
+        content={"deviceType": deviceType, "count": count},
+        headers=headers
+    )
+
+
+@app.get("/Log/auth/statistics/top")
+def get_top_users(
+    deviceType: str = Query(..., description="Device type to filter by"),
+    limit: int = Query(10, ge=1, le=TOP_USERS_MAX_LIMIT, description="How many users to return")
+):
+    """
+    Returns the most active user_keys for a device type.
+
+    Reads the heavy-hitter summaries that each Device Registration API
+    process persists (see persist_heavy_hitters there) and merges them by
+    summing counts per user. Counts of heavy users are upper bounds; users
+    a process has evicted from its summary count nothing there, so tail
+    counts can be under-estimates. Counts lag behind by up to one flush
+    interval — but the query touches a few thousand rows instead of
+    grouping the whole device_registrations table.
+
+    Returns:
+        200 — {"deviceType": "...", "top": [{"userKey": "...", "count": N}, ...]}
+        400 — invalid device type or database error
+    """
+    if deviceType not in VALID_DEVICE_TYPES:
+        return JSONResponse(
+            status_code=400,
+            content={"statusCode": 400, "message": "bad_request"}
+        )
+
+    def read_top_users(conn):
+        cursor = conn.cursor()
         cursor.execute(
-            "SELECT COUNT(*) FROM device_registrations WHERE device_type = %s",
-            (deviceType,)
+            """
+            SELECT user_key, SUM(count) AS total
+            FROM heavy_hitters
+            WHERE device_type = %s
+            GROUP BY user_key
+            ORDER BY total DESC, user_key
+            LIMIT %s
+            """,
+            (deviceType, limit)
         )
-        count = cursor.fetchone()[0]
+        return cursor.fetchall()
 
-        return {"deviceType": deviceType, "count": count}
+    try:
+        rows = with_db_connection(read_top_users)
+        mark_stage("db_query")
+
+        return {
+            "deviceType": deviceType,
+            "top": [{"userKey": user_key, "count": int(total)} for user_key, total in rows]
+        }
 
     except Exception as e:
-        return {"deviceType": deviceType, "count": -1}
+        return JSONResponse(
+            status_code=400,
+            content={"statusCode": 400, "message": "bad_request"}
+        )
+
+
+@app.get("/debug/profile", include_in_schema=False)
+def profile(
+    seconds: float = Query(10, gt=0, le=PROFILING_MAX_SECONDS, description="How long to sample for"),
+    x_admin_token: str = Header(None)
+):
+    """
+    Admin-only: samples the live process for N seconds and returns the
+    stacks in collapsed-stack format (pipe into flamegraph.pl or load in
+    speedscope). Runs in the threadpool, so traffic keeps being served
+    while it samples.
+
+    Returns:
+        200 — collapsed stacks as text/plain
+        403 — missing or wrong X-Admin-Token
+        404 — profiling is disabled (the default)
+        409 — another profile is already running
+    """
+    if not PROFILING_ENABLED:
+        return JSONResponse(status_code=404, content={"detail": "Not Found"})
 
+    import hmac  # only needed here, keep it off the startup path
+
+    # Compare bytes — compare_digest raises on non-ASCII str. Header values
+    # arrive latin-1 decoded, so encoding them back never fails; the token
+    # is ASCII (checked at startup), the same bytes in either encoding.
+    presented = (x_admin_token or "").encode("latin-1")
+    if not PROFILING_TOKEN or not hmac.compare_digest(presented, PROFILING_TOKEN.encode("latin-1")):
+        return JSONResponse(status_code=403, content={"detail": "Forbidden"})
+
+    if not _profiling_lock.acquire(blocking=False):
+        return JSONResponse(status_code=409, content={"detail": "Profile already running"})
+    try:
+        return PlainTextResponse(collect_stack_samples(seconds, PROFILING_SAMPLE_INTERVAL_MS))
     finally:
-        if conn:
-            conn.close()
+        _profiling_lock.release()
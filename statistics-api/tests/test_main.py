@@ -3,18 +3,31 @@
 import pytest
 from fastapi.testclient import TestClient
 from unittest.mock import Mock, patch, AsyncMock
+import asyncio
+import httpx
+import msgpack
+import psycopg2
 import sys
 import os
+import time
 
 # Add parent directory to path so we can import main
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from main import app, VALID_DEVICE_TYPES
+from main import app, KeepAliveConnectionPool, SlowRequestTimer, VALID_DEVICE_TYPES, DB_POOL_MAX_SIZE, _statistics_cache, get_db_connection
+from main import RegistrationBatcher, with_db_connection
+import main
 
 # Create test client
 client = TestClient(app)
 
 
+@pytest.fixture(autouse=True)
+def clear_statistics_cache():
+    """Every test starts with an empty per-pod statistics cache"""
+    _statistics_cache.clear()
+
+
 class TestHealthEndpoint:
     """Tests for GET /health"""
 
@@ -25,11 +38,175 @@ class TestHealthEndpoint:
         assert response.json() == {"status": "ok", "service": "statistics-api"}
 
 
+class TestReadinessEndpoint:
+    """Tests for GET /ready and the startup warm-up"""
+
+    @pytest.fixture(autouse=True)
+    def cold_pod(self):
+        """Each test starts from a pod that has not warmed up yet"""
+        with patch('main._warm', False), patch('main._warmup_ms', None):
+            yield
+
+    @patch('main.get_db_pool')
+    def test_ready_returns_503_while_database_unreachable(self, mock_pool):
+        """Readiness should fail until the DB pool can be opened"""
+        mock_pool.side_effect = psycopg2.OperationalError("connection refused")
+
+        response = client.get("/ready")
+
+        assert response.status_code == 503
+        assert response.json()["status"] == "warming_up"
+
+    @patch('main.get_http_client')
+    @patch('main.get_db_pool')
+    def test_ready_after_warm_up(self, mock_pool, mock_client):
+        """Readiness should flip once the pool is open and stay ready"""
+        mock_client.return_value = AsyncMock()
+
+        first = client.get("/ready")
+        second = client.get("/ready")
+
+        assert first.status_code == 200
+        assert first.json()["status"] == "ready"
+        assert second.status_code == 200
+        mock_pool.assert_called_once()
+
+    @pytest.mark.asyncio
+    @patch('main.get_http_client')
+    async def test_concurrent_warm_ups_share_one_attempt(self, mock_client):
+        """Probes arriving during a slow connect should wait for it, not start their own"""
+        mock_client.return_value = AsyncMock()
+        attempts = []
+
+        def slow_pool():
+            attempts.append(1)
+            time.sleep(0.05)
+
+        with patch('main.get_db_pool', side_effect=slow_pool):
+            results = await asyncio.gather(*(main.warm_up() for _ in range(5)))
+
+        assert results == [True] * 5
+        assert len(attempts) == 1
+
+    @patch('main.get_http_client')
+    @patch('main.get_db_pool')
+    def test_ready_does_not_depend_on_device_api(self, mock_pool, mock_client):
+        """An unreachable Device Registration API should not block readiness"""
+        mock_async_client = AsyncMock()
+        mock_async_client.get.side_effect = httpx.ConnectError("connection refused")
+        mock_client.return_value = mock_async_client
+
+        response = client.get("/ready")
+
+        assert response.status_code == 200
+
+
+class TestConnectionPool:
+    """Tests for the pooled get_db_connection()"""
+
+    @patch('main.get_db_pool')
+    def test_close_returns_connection_to_pool(self, mock_pool):
+        """close() on a borrowed connection should put it back, not close it"""
+        raw_conn = Mock(closed=0)
+        mock_pool.return_value.getconn.return_value = raw_conn
+
+        conn = get_db_connection()
+        conn.close()
+        conn.close()  # second close is a no-op
+
+        mock_pool.return_value.putconn.assert_called_once_with(raw_conn, close=False)
+        raw_conn.close.assert_not_called()
+
+    @patch('psycopg2.connect')
+    def test_pool_keeps_returned_connections_open(self, mock_connect):
+        """Returning more than minconn connections should keep them all for reuse"""
+        mock_connect.side_effect = lambda *args, **kwargs: Mock(
+            closed=False, info=Mock(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+        )
+        pool = KeepAliveConnectionPool(2, 10)
+
+        borrowed = [pool.getconn() for _ in range(5)]
+        for conn in borrowed:
+            pool.putconn(conn)
+
+        for conn in borrowed:
+            conn.close.assert_not_called()
+        reused = [pool.getconn() for _ in range(5)]
+        assert sorted(map(id, reused)) == sorted(map(id, borrowed))
+        assert mock_connect.call_count == 5
+
+    def _connections(self, dead: int):
+        """psycopg2.connect stand-in: the first `dead` connections fail like after a server restart"""
+        opened = []
+
+        def connect(*args, **kwargs):
+            conn = Mock(closed=0, info=Mock(transaction_status=psycopg2.extensions.TRANSACTION_STATUS_IDLE))
+            if len(opened) < dead:
+                def lost(*args):
+                    conn.closed = 2
+                    raise psycopg2.OperationalError("server closed the connection unexpectedly")
+                conn.cursor.return_value.execute.side_effect = lost
+            opened.append(conn)
+            return conn
+
+        return connect, opened
+
+    @patch('psycopg2.connect')
+    def test_lost_connection_is_replaced_and_retried(self, mock_connect):
+        """After a database restart, dead pooled connections should be dropped and the query retried once"""
+        mock_connect.side_effect, opened = self._connections(dead=2)
+        pool = KeepAliveConnectionPool(2, 10)
+
+        def query(conn):
+            conn.cursor().execute("SELECT 1")
+            return "ok"
+
+        with patch('main.get_db_pool', return_value=pool):
+            result = with_db_connection(query)
+
+        assert result == "ok"
+        assert len(opened) == 3
+        opened[0].close.assert_called()
+        opened[1].close.assert_called()  # idle, but died with the same restart
+        opened[2].close.assert_not_called()
+
+    @patch('psycopg2.connect')
+    def test_lost_connection_is_not_retried_after_commit(self, mock_connect):
+        """A COMMIT lost with the connection may have been applied — it must not run twice"""
+        mock_connect.side_effect, opened = self._connections(dead=2)
+        pool = KeepAliveConnectionPool(2, 10)
+
+        def insert(conn):
+            conn.commit()
+            conn.cursor().execute("SELECT 1")
+
+        with patch('main.get_db_pool', return_value=pool):
+            with pytest.raises(psycopg2.OperationalError):
+                with_db_connection(insert)
+
+        assert len(opened) == 2
+
+    @patch('main.DB_POOL_TIMEOUT', 0.01)
+    @patch('main.get_db_pool')
+    def test_exhausted_pool_times_out(self, mock_pool):
+        """Borrowing beyond DB_POOL_MAX_SIZE should wait, then raise"""
+        borrowed = [get_db_connection() for _ in range(DB_POOL_MAX_SIZE)]
+        try:
+            with pytest.raises(TimeoutError):
+                get_db_connection()
+        finally:
+            for conn in borrowed:
+                conn.close()
+
+        # Slots are free again once connections are returned
+        get_db_connection().close()
+
+
 class TestLogAuthEndpoint:
     """Tests for POST /Log/auth"""
 
     @pytest.mark.asyncio
-    @patch('main.httpx.AsyncClient')
+    @patch('main.get_http_client')
     async def test_log_auth_valid_device_success(self, mock_client):
         """Valid device type should call Device Registration API and return success"""
         # Mock the httpx response
@@ -38,7 +215,7 @@ class TestLogAuthEndpoint:
 
         mock_async_client = AsyncMock()
         mock_async_client.post.return_value = mock_response
-        mock_client.return_value.__aenter__.return_value = mock_async_client
+        mock_client.return_value = mock_async_client
 
         response = client.post(
             "/Log/auth",
@@ -59,7 +236,7 @@ class TestLogAuthEndpoint:
         assert response.json() == {"statusCode": 400, "message": "bad_request"}
 
     @pytest.mark.asyncio
-    @patch('main.httpx.AsyncClient')
+    @patch('main.get_http_client')
     async def test_log_auth_device_api_error(self, mock_client):
         """Device Registration API returning error should return bad_request"""
         # Mock the httpx response with error status
@@ -68,7 +245,7 @@ class TestLogAuthEndpoint:
 
         mock_async_client = AsyncMock()
         mock_async_client.post.return_value = mock_response
-        mock_client.return_value.__aenter__.return_value = mock_async_client
+        mock_client.return_value = mock_async_client
 
         response = client.post(
             "/Log/auth",
@@ -79,13 +256,13 @@ class TestLogAuthEndpoint:
         assert response.json() == {"statusCode": 400, "message": "bad_request"}
 
     @pytest.mark.asyncio
-    @patch('main.httpx.AsyncClient')
+    @patch('main.get_http_client')
     async def test_log_auth_network_error(self, mock_client):
         """Network error should return bad_request"""
         # Mock network error
         mock_async_client = AsyncMock()
         mock_async_client.post.side_effect = Exception("Network error")
-        mock_client.return_value.__aenter__.return_value = mock_async_client
+        mock_client.return_value = mock_async_client
 
         response = client.post(
             "/Log/auth",
@@ -96,6 +273,97 @@ class TestLogAuthEndpoint:
         assert response.json() == {"statusCode": 400, "message": "bad_request"}
 
 
+class TestMsgpackTransport:
+    """Tests for the compact msgpack transport (DEVICE_API_PROTOCOL=msgpack)"""
+
+    def _mock_batch_client(self, mock_client, statuses, status_code=200):
+        mock_response = Mock()
+        mock_response.status_code = status_code
+        mock_response.content = msgpack.packb(statuses)
+        mock_async_client = AsyncMock()
+        mock_async_client.post.return_value = mock_response
+        mock_client.return_value = mock_async_client
+        return mock_async_client
+
+    @patch('main.get_http_client')
+    async def test_concurrent_submits_share_one_batch(self, mock_client):
+        """Concurrent registrations should go out as one msgpack request"""
+        mock_async_client = self._mock_batch_client(mock_client, [200, 400])
+        batcher = RegistrationBatcher(max_size=64, max_wait_ms=5)
+
+        results = await asyncio.gather(
+            batcher.submit("user-a", "iOS"),
+            batcher.submit("user-b", "TV")
+        )
+
+        assert results == [200, 400]
+        mock_async_client.post.assert_called_once()
+        url = mock_async_client.post.call_args[0][0]
+        kwargs = mock_async_client.post.call_args[1]
+        assert url.endswith("/Device/register/batch")
+        assert kwargs["headers"]["Content-Type"] == "application/msgpack"
+        assert msgpack.unpackb(kwargs["content"]) == [["user-a", "iOS"], ["user-b", "TV"]]
+
+    @patch('main.get_http_client')
+    async def test_full_batch_is_sent_without_waiting(self, mock_client):
+        """Reaching max_size should send immediately, not after max_wait_ms"""
+        mock_async_client = self._mock_batch_client(mock_client, [200, 200])
+        batcher = RegistrationBatcher(max_size=2, max_wait_ms=60_000)
+
+        results = await asyncio.wait_for(
+            asyncio.gather(batcher.submit("user-a", "iOS"), batcher.submit("user-b", "iOS")),
+            timeout=1
+        )
+
+        assert results == [200, 200]
+        mock_async_client.post.assert_called_once()
+
+    @patch('main.get_http_client')
+    async def test_failed_batch_fails_every_item(self, mock_client):
+        """Network errors or malformed replies should fail all items in the batch"""
+        mock_async_client = AsyncMock()
+        mock_async_client.post.side_effect = httpx.ConnectError("connection refused")
+        mock_client.return_value = mock_async_client
+        batcher = RegistrationBatcher(max_size=64, max_wait_ms=1)
+
+        results = await asyncio.gather(batcher.submit("user-a", "iOS"), batcher.submit("user-b", "TV"))
+
+        assert results == [502, 502]
+
+    @patch('main.get_http_client')
+    async def test_mismatched_reply_fails_every_item(self, mock_client):
+        """A reply with the wrong number of statuses should fail the batch"""
+        self._mock_batch_client(mock_client, [200])
+        batcher = RegistrationBatcher(max_size=64, max_wait_ms=1)
+
+        results = await asyncio.gather(batcher.submit("user-a", "iOS"), batcher.submit("user-b", "TV"))
+
+        assert results == [502, 502]
+
+    @patch('main.DEVICE_API_PROTOCOL', 'msgpack')
+    @patch('main.get_registration_batcher')
+    def test_log_auth_uses_batcher(self, mock_batcher):
+        """With msgpack selected, /Log/auth should go through the batcher"""
+        mock_batcher.return_value.submit = AsyncMock(return_value=200)
+
+        response = client.post("/Log/auth", json={"userKey": "user123", "deviceType": "iOS"})
+
+        assert response.status_code == 200
+        assert response.json() == {"statusCode": 200, "message": "success"}
+        mock_batcher.return_value.submit.assert_awaited_once_with("user123", "iOS")
+
+    @patch('main.DEVICE_API_PROTOCOL', 'msgpack')
+    @patch('main.get_registration_batcher')
+    def test_log_auth_batch_failure_returns_bad_request(self, mock_batcher):
+        """A failed batch item should map to the usual bad_request response"""
+        mock_batcher.return_value.submit = AsyncMock(return_value=502)
+
+        response = client.post("/Log/auth", json={"userKey": "user123", "deviceType": "iOS"})
+
+        assert response.status_code == 400
+        assert response.json() == {"statusCode": 400, "message": "bad_request"}
+
+
 class TestGetStatisticsEndpoint:
     """Tests for GET /Log/auth/statistics"""
 
@@ -154,6 +422,235 @@ class TestGetStatisticsEndpoint:
         assert response.json() == {"deviceType": "TV", "count": 0}
 
 
+class TestStatisticsCaching:
+    """Tests for ETag / Cache-Control on GET /Log/auth/statistics"""
+
+    def _mock_count(self, mock_db_conn, count):
+        mock_cursor = Mock()
+        mock_cursor.fetchone.return_value = (count,)
+        mock_conn = Mock()
+        mock_conn.cursor.return_value = mock_cursor
+        mock_db_conn.return_value = mock_conn
+
+    @patch('main.STATISTICS_CACHE_MAX_AGE', 30)
+    @patch('main.get_db_connection')
+    def test_statistics_sends_caching_headers(self, mock_db_conn):
+        """Successful reads should carry an ETag and Cache-Control max-age"""
+        self._mock_count(mock_db_conn, 5)
+
+        response = client.get("/Log/auth/statistics?deviceType=iOS")
+
+        assert response.status_code == 200
+        assert response.headers["etag"] == '"iOS-5"'
+        assert response.headers["cache-control"] == "public, max-age=30"
+
+    @patch('main.get_db_connection')
+    def test_statistics_not_modified_without_database(self, mock_db_conn):
+        """Matching If-None-Match on a fresh count should 304 without a DB query"""
+        self._mock_count(mock_db_conn, 5)
+
+        first = client.get("/Log/auth/statistics?deviceType=iOS")
+        second = client.get(
+            "/Log/auth/statistics?deviceType=iOS",
+            headers={"If-None-Match": first.headers["etag"]}
+        )
+
+        assert second.status_code == 304
+        assert second.content == b""
+        assert second.headers["etag"] == first.headers["etag"]
+        mock_db_conn.assert_called_once()
+
+    @patch('main.get_db_connection')
+    def test_statistics_changed_count_returns_body(self, mock_db_conn):
+        """A stale ETag should get the new count and the new ETag"""
+        self._mock_count(mock_db_conn, 6)
+
+        response = client.get(
+            "/Log/auth/statistics?deviceType=iOS",
+            headers={"If-None-Match": '"iOS-5"'}
+        )
+
+        assert response.status_code == 200
+        assert response.json() == {"deviceType": "iOS", "count": 6}
+        assert response.headers["etag"] == '"iOS-6"'
+
+    @patch('main.STATISTICS_CACHE_MAX_AGE', 0)
+    @patch('main.get_db_connection')
+    def test_statistics_cache_disabled_queries_every_time(self, mock_db_conn):
+        """max-age 0 should query on every request but still honour If-None-Match"""
+        self._mock_count(mock_db_conn, 5)
+
+        client.get("/Log/auth/statistics?deviceType=TV")
+        response = client.get(
+            "/Log/auth/statistics?deviceType=TV",
+            headers={"If-None-Match": 'W/"TV-5"'}
+        )
+
+        assert response.status_code == 304
+        assert mock_db_conn.call_count == 2
+
+    @pytest.mark.asyncio
+    @patch('main.get_http_client')
+    @patch('main.get_db_connection')
+    async def test_log_auth_invalidates_cached_count(self, mock_db_conn, mock_client):
+        """A successful registration on this pod should drop its cached count"""
+        self._mock_count(mock_db_conn, 5)
+        client.get("/Log/auth/statistics?deviceType=iOS")
+
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_async_client = AsyncMock()
+        mock_async_client.post.return_value = mock_response
+        mock_client.return_value = mock_async_client
+
+        client.post("/Log/auth", json={"userKey": "user123", "deviceType": "iOS"})
+
+        self._mock_count(mock_db_conn, 6)
+        response = client.get("/Log/auth/statistics?deviceType=iOS")
+
+        assert response.json() == {"deviceType": "iOS", "count": 6}
+
+    @patch('main.get_db_connection')
+    def test_statistics_errors_are_not_cached(self, mock_db_conn):
+        """Error responses should tell caches not to store them"""
+        mock_db_conn.side_effect = Exception("Database connection failed")
+
+        response = client.get("/Log/auth/statistics?deviceType=Android")
+
+        assert response.json() == {"deviceType": "Android", "count": -1}
+        assert response.headers["cache-control"] == "no-store"
+        assert "etag" not in response.headers
+
+
+class TestCacheInvalidation:
+    """Tests for cross-pod invalidation through the registration listener"""
+
+    def _mock_count(self, mock_db_conn, count):
+        mock_cursor = Mock()
+        mock_cursor.fetchone.return_value = (count,)
+        mock_conn = Mock()
+        mock_conn.cursor.return_value = mock_cursor
+        mock_db_conn.return_value = mock_conn
+        return mock_cursor
+
+    @patch('main.get_db_connection')
+    def test_notification_drops_only_its_device_type(self, mock_db_conn):
+        """A notification for iOS should leave other cached counts alone"""
+        self._mock_count(mock_db_conn, 5)
+        client.get("/Log/auth/statistics?deviceType=iOS")
+        client.get("/Log/auth/statistics?deviceType=TV")
+
+        main.invalidate_statistics("iOS")
+
+        assert "iOS" not in _statistics_cache
+        assert "TV" in _statistics_cache
+
+    @patch('main.get_db_connection')
+    def test_unknown_payload_drops_everything(self, mock_db_conn):
+        """An unexpected payload (or a reconnect) should invalidate every count"""
+        self._mock_count(mock_db_conn, 5)
+        client.get("/Log/auth/statistics?deviceType=iOS")
+        client.get("/Log/auth/statistics?deviceType=TV")
+
+        main.invalidate_statistics("Windows")
+
+        assert _statistics_cache == {}
+
+    @patch('main.get_db_connection')
+    def test_count_read_during_invalidation_is_not_cached(self, mock_db_conn):
+        """A count that may predate a notification must not be cached"""
+        mock_cursor = self._mock_count(mock_db_conn, 5)
+        mock_cursor.execute.side_effect = lambda *args: main.invalidate_statistics("iOS")
+
+        response = client.get("/Log/auth/statistics?deviceType=iOS")
+
+        assert response.json() == {"deviceType": "iOS", "count": 5}
+        assert "iOS" not in _statistics_cache
+
+    @patch('main.STATISTICS_NOTIFY_MAX_AGE', 60)
+    @patch('main.STATISTICS_CACHE_MAX_AGE', 5)
+    def test_listener_extends_cache_lifetime(self):
+        """While listening, counts stay cached past STATISTICS_CACHE_MAX_AGE"""
+        _statistics_cache["iOS"] = (5, main.time.monotonic() - 10)
+
+        with patch('main._listener_connected', False):
+            assert main.get_cached_count("iOS") is None
+        with patch('main._listener_connected', True):
+            assert main.get_cached_count("iOS") == 5
+
+    def test_listener_invalidates_on_notify_and_stops(self):
+        """The listener thread should LISTEN, apply notifications and exit on stop"""
+        notification = Mock(payload="Watch")
+        mock_conn = Mock()
+        mock_conn.notifies = []
+
+        def poll():
+            mock_conn.notifies.append(notification)
+            main._listener_stop.set()
+
+        mock_conn.poll.side_effect = poll
+        _statistics_cache["Watch"] = (3, main.time.monotonic())
+
+        with patch('main.psycopg2.connect', return_value=mock_conn), \
+             patch('main.select.select', return_value=([mock_conn], [], [])), \
+             patch('main.invalidate_statistics', wraps=main.invalidate_statistics) as mock_invalidate:
+            main._listener_stop.clear()
+            main.listen_for_registrations()
+
+        mock_conn.cursor.return_value.execute.assert_called_once_with("LISTEN device_registrations")
+        mock_invalidate.assert_any_call("Watch")
+        assert "Watch" not in _statistics_cache
+        assert main._listener_connected is False
+        mock_conn.close.assert_called_once()
+        main._listener_stop.clear()
+
+
+class TestTopUsersEndpoint:
+    """Tests for GET /Log/auth/statistics/top"""
+
+    @patch('main.get_db_connection')
+    def test_top_users_returns_merged_counts(self, mock_db_conn):
+        """Should return the summed heavy-hitter counts, most active first"""
+        mock_cursor = Mock()
+        mock_cursor.fetchall.return_value = [("user-a", 120), ("user-b", 75)]
+        mock_conn = Mock()
+        mock_conn.cursor.return_value = mock_cursor
+        mock_db_conn.return_value = mock_conn
+
+        response = client.get("/Log/auth/statistics/top?deviceType=iOS&limit=2")
+
+        assert response.status_code == 200
+        assert response.json() == {
+            "deviceType": "iOS",
+            "top": [{"userKey": "user-a", "count": 120}, {"userKey": "user-b", "count": 75}]
+        }
+        query, params = mock_cursor.execute.call_args[0]
+        assert "FROM heavy_hitters" in query
+        assert params == ("iOS", 2)
+        mock_conn.close.assert_called_once()
+
+    def test_top_users_invalid_device_type(self):
+        """Invalid device type should return 400 bad_request"""
+        response = client.get("/Log/auth/statistics/top?deviceType=Windows")
+
+        assert response.status_code == 400
+        assert response.json() == {"statusCode": 400, "message": "bad_request"}
+
+    def test_top_users_limit_is_bounded(self):
+        """limit outside 1..100 should be rejected by validation"""
+        assert client.get("/Log/auth/statistics/top?deviceType=iOS&limit=0").status_code == 422
+        assert client.get("/Log/auth/statistics/top?deviceType=iOS&limit=1000").status_code == 422
+
+    @patch('main.get_db_connection')
+    def test_top_users_database_error(self, mock_db_conn):
+        """Database error should return 400 bad_request"""
+        mock_db_conn.side_effect = Exception("Database connection failed")
+
+        response = client.get("/Log/auth/statistics/top?deviceType=Android")
+
+        assert response.status_code == 400
+
+
 class TestInputValidation:
     """Tests for input validation logic"""
 
@@ -168,3 +665,169 @@ class TestInputValidation:
         """Missing deviceType parameter should return 422 (FastAPI validation)"""
         response = client.get("/Log/auth/statistics")
         assert response.status_code == 422  # FastAPI validation error
+
+
+class TestProfilingEndpoint:
+    """Tests for GET /debug/profile"""
+
+    def test_profile_disabled_by_default(self):
+        """Profiling endpoint should not exist unless explicitly enabled"""
+        response = client.get("/debug/profile?seconds=0.01", headers={"X-Admin-Token": "secret"})
+        assert response.status_code == 404
+
+    @patch('main.PROFILING_TOKEN', 'secret')
+    @patch('main.PROFILING_ENABLED', True)
+    def test_profile_rejects_wrong_token(self):
+        """Wrong or missing admin token should return 403"""
+        response = client.get("/debug/profile?seconds=0.01", headers={"X-Admin-Token": "wrong"})
+        assert response.status_code == 403
+
+        # Non-ASCII tokens must be rejected, not crash the comparison
+        response = client.get("/debug/profile?seconds=0.01", headers={"X-Admin-Token": "sécret".encode()})
+        assert response.status_code == 403
+
+        response = client.get("/debug/profile?seconds=0.01")
+        assert response.status_code == 403
+
+    def test_non_ascii_token_is_rejected_at_startup(self):
+        """A token the header bytes could never reliably match should stop the service"""
+        import subprocess
+        env = dict(os.environ, PROFILING_ENABLED="true", PROFILING_TOKEN="sécret")
+        result = subprocess.run(
+            [sys.executable, "-c", "import main"],
+            cwd=os.path.join(os.path.dirname(__file__), '..'), env=env, capture_output=True, text=True
+        )
+
+        assert result.returncode != 0
+        assert "PROFILING_TOKEN must be ASCII" in result.stderr
+
+    @patch('main.PROFILING_TOKEN', 'secret')
+    @patch('main.PROFILING_ENABLED', True)
+    def test_profile_returns_collapsed_stacks(self):
+        """Enabled profiler should return 'frame;frame count' lines"""
+        response = client.get("/debug/profile?seconds=0.05", headers={"X-Admin-Token": "secret"})
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+
+        lines = response.text.strip().splitlines()
+        assert lines
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            assert stack
+            assert int(count) > 0
+
+    @patch('main.PROFILING_TOKEN', 'secret')
+    @patch('main.PROFILING_ENABLED', True)
+    def test_profile_duration_is_bounded(self):
+        """Sampling longer than the maximum should be rejected by validation"""
+        response = client.get("/debug/profile?seconds=3600", headers={"X-Admin-Token": "secret"})
+        assert response.status_code == 422
+
+
+class TestSlowRequestTimer:
+    """Tests for the slow-request stage breakdown log"""
+
+    # The timer is only installed when SLOW_REQUEST_THRESHOLD_MS is set at
+    # startup, so wrap the app explicitly
+    timed_client = TestClient(SlowRequestTimer(app))
+
+    @patch('main.SLOW_REQUEST_THRESHOLD_MS', 0.001)
+    @patch('main.get_db_connection')
+    def test_slow_request_logs_stage_breakdown(self, mock_db_conn, caplog):
+        """Requests above the threshold should be logged with their stages"""
+        mock_cursor = Mock()
+        mock_cursor.fetchone.return_value = (5,)
+        mock_conn = Mock()
+        mock_conn.cursor.return_value = mock_cursor
+        mock_db_conn.return_value = mock_conn
+
+        with caplog.at_level("WARNING", logger="statistics-api"):
+            response = self.timed_client.get("/Log/auth/statistics?deviceType=iOS")
+
+        assert response.status_code == 200
+        assert "slow request: GET /Log/auth/statistics" in caplog.text
+        assert "db_connect=" in caplog.text
+        assert "db_query=" in caplog.text
+
+    @patch('main.get_db_connection')
+    def test_slow_request_timer_off_by_default(self, mock_db_conn, caplog):
+        """With no threshold configured nothing should be logged"""
+        mock_db_conn.side_effect = Exception("Database connection failed")
+
+        with caplog.at_level("WARNING", logger="statistics-api"):
+            self.timed_client.get("/Log/auth/statistics?deviceType=iOS")
+
+        assert "slow request" not in caplog.text
+
+    def test_slow_request_timer_not_installed_by_default(self):
+        """With no threshold at startup the middleware should not wrap the app at all"""
+        assert SlowRequestTimer not in [middleware.cls for middleware in app.user_middleware]
+
+
+class TestSaturationMetrics:
+    """Tests for GET /metrics (saturation gauges for autoscaling)"""
+
+    def _metric(self, body: str, name: str) -> float:
+        for line in body.splitlines():
+            if line.startswith(f"{name} "):
+                return float(line.split()[1])
+        raise AssertionError(f"{name} not exported")
+
+    def test_metrics_exports_all_gauges(self):
+        """Every saturation gauge should be present in Prometheus text format"""
+        response = client.get("/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+        for name in main.METRICS_HELP:
+            assert f"# TYPE {name} gauge" in response.text
+        assert self._metric(response.text, "db_pool_connections_max") == DB_POOL_MAX_SIZE
+        assert self._metric(response.text, "http_requests_in_flight") == 0
+
+    @patch('main.get_db_pool')
+    def test_pool_gauges_follow_borrowed_connections(self, mock_pool):
+        """Borrowing and returning a connection should move db_pool_connections_in_use"""
+        conn = get_db_connection()
+        assert self._metric(client.get("/metrics").text, "db_pool_connections_in_use") == 1
+
+        conn.close()
+        assert self._metric(client.get("/metrics").text, "db_pool_connections_in_use") == 0
+
+    @pytest.mark.asyncio
+    @patch('main.get_http_client')
+    async def test_downstream_call_is_counted_while_pending(self, mock_client):
+        """A POST /Log/auth waiting on the Device Registration API should show as pending"""
+        seen = []
+
+        async def post(*args, **kwargs):
+            seen.append(self._metric(main.render_metrics(), "downstream_pending_calls"))
+            return Mock(status_code=200)
+
+        mock_async_client = AsyncMock()
+        mock_async_client.post.side_effect = post
+        mock_client.return_value = mock_async_client
+
+        client.post("/Log/auth", json={"userKey": "user123", "deviceType": "iOS"})
+
+        assert seen == [1]
+        assert self._metric(main.render_metrics(), "downstream_pending_calls") == 0
+
+    @pytest.mark.asyncio
+    @patch('main.get_http_client')
+    async def test_request_is_counted_while_in_flight(self, mock_client):
+        """A POST /Log/auth being processed should show in http_requests_in_flight"""
+        seen = []
+
+        async def post(*args, **kwargs):
+            seen.append(self._metric(main.render_metrics(), "http_requests_in_flight"))
+            return Mock(status_code=200)
+
+        mock_async_client = AsyncMock()
+        mock_async_client.post.side_effect = post
+        mock_client.return_value = mock_async_client
+
+        client.post("/Log/auth", json={"userKey": "user123", "deviceType": "iOS"})
+
+        assert seen == [1]
+        assert self._metric(main.render_metrics(), "http_requests_in_flight") == 0
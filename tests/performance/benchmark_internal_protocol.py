@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# tests/performance/benchmark_internal_protocol.py
+# Compares the two statistics-api -> device-registration-api transports:
+#   json    — one JSON POST /Device/register per registration (default)
+#   msgpack — msgpack POST /Device/register/batch with many registrations per call
+#
+# Two parts:
+#   --codec-only  encode/decode + validation cost per message, no stack needed
+#   (default)     live POST /Log/auth throughput through the whole path, once against
+#                 a Statistics API running each protocol — start the stack with
+#                 docker-compose.perf.yml, which runs the msgpack one on port 8002
+#
+#   python tests/performance/benchmark_internal_protocol.py --registrations 20000 --concurrency 64
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+import timeit
+
+import httpx
+import msgpack
+
+# Statistics API with each transport — docker-compose.perf.yml runs both
+JSON_API_URL = "http://localhost:8000"
+MSGPACK_API_URL = "http://localhost:8002"
+
+# ANSI color codes for output
+GREEN = '\033[92m'
+RED = '\033[91m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+
+def make_registrations(count: int) -> list:
+    """Registrations with user keys that are easy to find (and delete) afterwards."""
+    device_types = ["iOS", "Android", "Watch", "TV"]
+    return [(f"bench-{i:08d}", device_types[i % 4]) for i in range(count)]
+
+
+def benchmark_codecs(batch_size: int):
+    """
+    Per-registration CPU cost of each wire format, client encode + server
+    decode. The JSON path also pays for the Pydantic model the endpoint
+    validates into; the msgpack path validates in plain Python.
+    """
+    from pydantic import BaseModel
+
+    class RegisterRequest(BaseModel):
+        userKey: str
+        deviceType: str
+
+    items = make_registrations(batch_size)
+    single = {"userKey": items[0][0], "deviceType": items[0][1]}
+
+    def json_roundtrip():
+        body = json.dumps(single).encode()
+        RegisterRequest(**json.loads(body))
+
+    def msgpack_batch_roundtrip():
+        body = msgpack.packb(items)
+        for user_key, device_type in msgpack.unpackb(body):
+            isinstance(user_key, str) and device_type in ("iOS", "Android", "Watch", "TV")
+
+    runs = 2000
+    json_us = min(timeit.repeat(json_roundtrip, number=runs, repeat=5)) / runs * 1e6
+    msgpack_us = min(timeit.repeat(msgpack_batch_roundtrip, number=runs // 10, repeat=5)) / (runs // 10) / batch_size * 1e6
+
+    print(f"\n{'transport':<22} {'bytes/registration':>19} {'µs/registration':>16}")
+    print(f"{'json (1 per request)':<22} {len(json.dumps(single)):>19} {json_us:>16.2f}")
+    print(f"{f'msgpack (batch {batch_size})':<22} {len(msgpack.packb(items)) / batch_size:>19.1f} {msgpack_us:>16.2f}")
+
+
+async def run_log_auth(client: httpx.AsyncClient, items: list, concurrency: int) -> dict:
+    """
+    One POST /Log/auth per registration, `concurrency` in flight. The
+    Statistics API forwards each event with whatever transport it runs —
+    under msgpack its RegistrationBatcher coalesces the concurrent ones.
+    """
+    latencies, errors = [], 0
+    queue = iter(items)
+
+    async def worker():
+        nonlocal errors
+        for user_key, device_type in queue:
+            started = time.perf_counter()
+            try:
+                response = await client.post(
+                    "/Log/auth", json={"userKey": user_key, "deviceType": device_type}
+                )
+                ok = response.status_code == 200
+            except httpx.HTTPError:
+                ok = False
+            latencies.append((time.perf_counter() - started) * 1000)
+            errors += 0 if ok else 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {"latencies": latencies, "errors": errors}
+
+
+def print_row(name: str, result: dict, registrations: int, elapsed: float):
+    values = sorted(result["latencies"])
+    p99 = values[max(0, round(0.99 * len(values)) - 1)]
+    print(f"{name:<10} {registrations / elapsed:>12,.0f} "
+          f"{statistics.median(values):>9.1f} {p99:>9.1f} {result['errors']:>7}")
+
+
+async def benchmark_live(urls: dict, registrations: int, concurrency: int) -> int:
+    failed = False
+    print(f"\n{'protocol':<10} {'events/s':>12} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+
+    for protocol, url in urls.items():
+        # Separate keys per protocol, so each run inserts new rows
+        items = [(f"{user_key}-{protocol}", device_type) for user_key, device_type in make_registrations(registrations)]
+
+        async with httpx.AsyncClient(base_url=url, timeout=30.0) as client:
+            try:
+                (await client.get("/ready")).raise_for_status()
+            except httpx.HTTPError:
+                print(f"{RED}✗{RESET} Statistics API ({protocol}) not ready at {url}")
+                failed = True
+                continue
+
+            started = time.perf_counter()
+            result = await run_log_auth(client, items, concurrency)
+            print_row(protocol, result, registrations, time.perf_counter() - started)
+            failed = failed or result["errors"] > 0
+
+    print(f"\n{YELLOW}Rows were inserted with user_key 'bench-%'. Remove them with:{RESET}")
+    print("  DELETE FROM device_registrations WHERE user_key LIKE 'bench-%';")
+    return 1 if failed else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the internal JSON vs msgpack transport")
+    parser.add_argument("--json-url", default=JSON_API_URL,
+                        help=f"Statistics API running DEVICE_API_PROTOCOL=json (default: {JSON_API_URL})")
+    parser.add_argument("--msgpack-url", default=MSGPACK_API_URL,
+                        help=f"Statistics API running DEVICE_API_PROTOCOL=msgpack (default: {MSGPACK_API_URL})")
+    parser.add_argument("--registrations", type=int, default=10_000, help="POST /Log/auth events per protocol")
+    parser.add_argument("--concurrency", type=int, default=64, help="requests in flight")
+    parser.add_argument("--batch-size", type=int, default=64,
+                        help="registrations per msgpack batch in the codec part (the live run uses the "
+                             "server's DEVICE_API_BATCH_MAX_SIZE)")
+    parser.add_argument("--codec-only", action="store_true", help="only measure encode/decode cost, no HTTP")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print("=" * 60)
+    print("Benchmark - internal transport (JSON vs msgpack batches)")
+    print("=" * 60)
+
+    benchmark_codecs(args.batch_size)
+    if args.codec_only:
+        return 0
+
+    urls = {"json": args.json_url, "msgpack": args.msgpack_url}
+    return asyncio.run(benchmark_live(urls, args.registrations, args.concurrency))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
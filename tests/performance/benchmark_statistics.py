@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# tests/performance/benchmark_statistics.py
+# Measures GET /Log/auth/statistics latency under concurrent load.
+#
+# Run it against a table filled by seed_data.py. Start the stack with
+# docker-compose.perf.yml so the per-pod statistics cache is off and every
+# request really reaches PostgreSQL.
+#
+#   python tests/performance/benchmark_statistics.py --requests 2000 --concurrency 32
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import httpx
+import psycopg2
+
+# Base URL for the Statistics API (public endpoint)
+BASE_URL = "http://localhost:8000"
+
+# PostgreSQL connection parameters — only used to report the data size
+DB_HOST     = os.getenv("DB_HOST", "localhost")
+DB_PORT     = os.getenv("DB_PORT", "5432")
+DB_NAME     = os.getenv("DB_NAME", "devicedb")
+DB_USER     = os.getenv("DB_USER", "postgres")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
+
+DEVICE_TYPES = ["iOS", "Android", "Watch", "TV"]
+
+# ANSI color codes for output
+GREEN = '\033[92m'
+RED = '\033[91m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+
+def print_data_size():
+    """Prints row count and table/index size so results can be compared across runs."""
+    try:
+        conn = psycopg2.connect(
+            host=DB_HOST, port=DB_PORT, dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD
+        )
+    except psycopg2.Error as e:
+        print(f"{YELLOW}Could not reach PostgreSQL for data size ({e.__class__.__name__}) — skipping{RESET}")
+        return
+
+    try:
+        cursor = conn.cursor()
+        # reltuples is the planner's estimate — exact COUNT(*) would take as long as the benchmark
+        cursor.execute("""
+            SELECT c.reltuples::bigint,
+                   pg_size_pretty(pg_table_size(c.oid)),
+                   pg_size_pretty(pg_indexes_size(c.oid))
+            FROM pg_class c
+            WHERE c.relname = 'device_registrations'
+        """)
+        rows, table_size, index_size = cursor.fetchone()
+        print(f"device_registrations: ~{rows:,} rows, table {table_size}, indexes {index_size}")
+    finally:
+        conn.close()
+
+
+async def run_benchmark(url: str, device_types: list, total: int, concurrency: int) -> dict:
+    """
+    Fires `total` requests, at most `concurrency` at a time, cycling through
+    the device types. Returns latencies (ms) per device type and error count.
+    """
+    latencies = {device_type: [] for device_type in device_types}
+    errors = 0
+    next_request = 0
+
+    async with httpx.AsyncClient(base_url=url, timeout=60.0) as client:
+
+        async def worker():
+            nonlocal next_request, errors
+            while next_request < total:
+                device_type = device_types[next_request % len(device_types)]
+                next_request += 1
+
+                started = time.perf_counter()
+                try:
+                    response = await client.get("/Log/auth/statistics", params={"deviceType": device_type})
+                    ok = response.status_code == 200 and response.json()["count"] >= 0
+                except httpx.HTTPError:
+                    ok = False
+                elapsed_ms = (time.perf_counter() - started) * 1000
+
+                if ok:
+                    latencies[device_type].append(elapsed_ms)
+                else:
+                    errors += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    return {"latencies": latencies, "errors": errors}
+
+
+def percentile(values: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(values) - 1, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def print_report(result: dict, elapsed: float):
+    print(f"\n{'deviceType':<10} {'n':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    all_latencies = []
+    for device_type, values in result["latencies"].items():
+        if not values:
+            continue
+        values.sort()
+        all_latencies.extend(values)
+        print(f"{device_type:<10} {len(values):>7} {statistics.median(values):>9.1f} "
+              f"{percentile(values, 95):>9.1f} {percentile(values, 99):>9.1f} {values[-1]:>9.1f}")
+
+    all_latencies.sort()
+    if all_latencies:
+        print(f"{'all':<10} {len(all_latencies):>7} {statistics.median(all_latencies):>9.1f} "
+              f"{percentile(all_latencies, 95):>9.1f} {percentile(all_latencies, 99):>9.1f} "
+              f"{all_latencies[-1]:>9.1f}")
+
+    completed = len(all_latencies) + result["errors"]
+    print(f"\nThroughput: {completed / elapsed:,.1f} req/s over {elapsed:.1f}s")
+    if result["errors"]:
+        print(f"{RED}✗{RESET} {result['errors']} requests failed or returned count -1")
+    else:
+        print(f"{GREEN}✓{RESET} No errors")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark GET /Log/auth/statistics")
+    parser.add_argument("--url", default=BASE_URL, help=f"Statistics API base URL (default: {BASE_URL})")
+    parser.add_argument("--requests", type=int, default=1000, help="measured requests (default: 1000)")
+    parser.add_argument("--concurrency", type=int, default=16, help="requests in flight (default: 16)")
+    parser.add_argument("--warmup", type=int, default=50, help="unmeasured requests first (default: 50)")
+    parser.add_argument("--device-types", nargs="+", default=DEVICE_TYPES, choices=DEVICE_TYPES)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    print("=" * 60)
+    print("Benchmark - GET /Log/auth/statistics")
+    print("=" * 60)
+    print_data_size()
+
+    if args.warmup:
+        print(f"{YELLOW}Warming up with {args.warmup} requests...{RESET}")
+        asyncio.run(run_benchmark(args.url, args.device_types, args.warmup, args.concurrency))
+
+    print(f"Running {args.requests} requests at concurrency {args.concurrency}...")
+    started = time.perf_counter()
+    result = asyncio.run(run_benchmark(args.url, args.device_types, args.requests, args.concurrency))
+    print_report(result, time.perf_counter() - started)
+
+    return 1 if result["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
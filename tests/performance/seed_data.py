@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# tests/performance/seed_data.py
+# Bulk-loads synthetic device registrations for scale-testing the statistics path.
+#
+# Rows are generated in-process and streamed straight into COPY — nothing is
+# written to disk — with one connection per worker process loading in parallel.
+#
+#   python tests/performance/seed_data.py --rows 50000000 --workers 8 --drop-index
+
+import argparse
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+
+# PostgreSQL connection parameters — same variables and defaults as the APIs
+DB_HOST     = os.getenv("DB_HOST", "localhost")
+DB_PORT     = os.getenv("DB_PORT", "5432")
+DB_NAME     = os.getenv("DB_NAME", "devicedb")
+DB_USER     = os.getenv("DB_USER", "postgres")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
+
+# Share of registrations per device type — phones dominate, TV is the long tail
+DEVICE_TYPE_WEIGHTS = {"iOS": 0.46, "Android": 0.39, "Watch": 0.10, "TV": 0.05}
+
+# Share of registrations per hour of day (UTC) — quiet nights, evening peak
+HOURLY_WEIGHTS = [
+    2, 1, 1, 1, 1, 2, 4, 6, 7, 7, 6, 6,
+    7, 7, 6, 6, 7, 8, 9, 10, 10, 8, 5, 3,
+]
+
+# Index dropped during --drop-index loads and rebuilt afterwards (see init.sql)
+DEVICE_TYPE_INDEX = "idx_device_registrations_device_type"
+
+# Rows generated per read() refill of the COPY stream
+CHUNK_ROWS = 20_000
+
+# Bytes requested from the stream per network write
+COPY_READ_SIZE = 1 << 20
+
+# ANSI color codes for output
+GREEN = '\033[92m'
+YELLOW = '\033[93m'
+RESET = '\033[0m'
+
+
+def get_db_connection():
+    """Opens a connection with the same env vars the APIs use."""
+    return psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD
+    )
+
+
+class ZipfSampler:
+    """
+    Draws ranks 1..n with P(k) proportional to 1/k^s, using rejection-inversion
+    (Hörmann & Derflinger, 1996). Constant memory and time per sample, so it
+    works for hundreds of millions of distinct users.
+    """
+
+    def __init__(self, n: int, s: float, rng: random.Random):
+        self.n = n
+        self.s = s
+        self.rng = rng
+        self.h_integral_x1 = self._h_integral(1.5) - 1.0
+        self.h_integral_n = self._h_integral(n + 0.5)
+        self.threshold = 2.0 - self._h_integral_inverse(self._h_integral(2.5) - self._h(2.0))
+
+    def sample(self) -> int:
+        while True:
+            u = self.h_integral_n + self.rng.random() * (self.h_integral_x1 - self.h_integral_n)
+            x = self._h_integral_inverse(u)
+            k = min(max(int(x + 0.5), 1), self.n)
+            if k - x <= self.threshold or u >= self._h_integral(k + 0.5) - self._h(k):
+                return k
+
+    def _h(self, x: float) -> float:
+        return math.exp(-self.s * math.log(x))
+
+    def _h_integral(self, x: float) -> float:
+        log_x = math.log(x)
+        return _expm1_over_x((1.0 - self.s) * log_x) * log_x
+
+    def _h_integral_inverse(self, x: float) -> float:
+        t = max(x * (1.0 - self.s), -1.0)
+        return math.exp(_log1p_over_x(t) * x)
+
+
+def _expm1_over_x(x: float) -> float:
+    """(e^x - 1) / x, numerically stable around 0."""
+    if abs(x) > 1e-8:
+        return math.expm1(x) / x
+    return 1.0 + x * 0.5 * (1.0 + x / 3.0 * (1.0 + 0.25 * x))
+
+
+def _log1p_over_x(x: float) -> float:
+    """log(1 + x) / x, numerically stable around 0."""
+    if abs(x) > 1e-8:
+        return math.log1p(x) / x
+    return 1.0 - x * (0.5 - x * (1.0 / 3.0 - 0.25 * x))
+
+
+def user_key_for_rank(rank: int) -> str:
+    """
+    Maps a popularity rank to a stable user key. The multiplier is odd, so
+    the mapping is a bijection on 32 bits — hot users don't end up with
+    obviously sequential keys.
+    """
+    return f"user-{(rank * 2654435761) & 0xFFFFFFFF:08x}"
+
+
+class RegistrationStream:
+    """
+    File-like object that generates tab-separated rows on demand for
+    cursor.copy_expert(). Only one chunk of rows is held in memory.
+    """
+
+    def __init__(self, rows: int, users: int, zipf_s: float, days: int, seed: int, device_values: list):
+        self.remaining = rows
+        self.rng = random.Random(seed)
+        self.zipf = ZipfSampler(users, zipf_s, self.rng)
+        # What COPY stores per device type, in DEVICE_TYPE_WEIGHTS order
+        self.device_types = device_values
+        self.device_cum_weights = _cumulative(DEVICE_TYPE_WEIGHTS.values())
+        self.hour_cum_weights = _cumulative(HOURLY_WEIGHTS)
+
+        # Pre-format every calendar day once (plus one spare for rows moved
+        # off today, see below); rows only add the time part
+        now = datetime.now(timezone.utc)
+        self.days = [(now.date() - timedelta(days=offset)).isoformat() for offset in range(days + 1)]
+        self.last_day = days - 1
+        self.now_second_of_day = now.hour * 3600 + now.minute * 60 + now.second
+        self.buffer = b""
+        self.offset = 0
+
+    def read(self, size: int = -1) -> bytes:
+        # Hand out the current chunk piece by piece; generate the next one
+        # only when it is used up (avoids re-copying the tail on every read)
+        if self.offset >= len(self.buffer):
+            if self.remaining <= 0:
+                return b""
+            self.buffer = self._generate_chunk(min(CHUNK_ROWS, self.remaining))
+            self.offset = 0
+
+        end = len(self.buffer) if size < 0 else self.offset + size
+        data = self.buffer[self.offset:end]
+        self.offset += len(data)
+        return data
+
+    def _generate_chunk(self, count: int) -> bytes:
+        rng = self.rng
+        device_types = rng.choices(self.device_types, cum_weights=self.device_cum_weights, k=count)
+        hours = rng.choices(range(24), cum_weights=self.hour_cum_weights, k=count)
+
+        lines = []
+        for device_type, hour in zip(device_types, hours):
+            # Triangular with the mode at "today" — traffic grew over time
+            day = int(rng.triangular(0, self.last_day, 0))
+            second = rng.randrange(3600)
+            # Today only runs up to now — a later time of day moves to
+            # yesterday, so no row is in the future and the daily cycle holds
+            if day == 0 and hour * 3600 + second > self.now_second_of_day:
+                day = 1
+            lines.append(
+                f"{user_key_for_rank(self.zipf.sample())}\t{device_type}\t"
+                f"{self.days[day]} {hour:02d}:{second // 60:02d}:{second % 60:02d}\n"
+            )
+
+        self.remaining -= count
+        return "".join(lines).encode()
+
+
+def _cumulative(weights) -> list:
+    total = 0.0
+    result = []
+    for weight in weights:
+        total += weight
+        result.append(total)
+    return result
+
+
+def load_partition(args: tuple) -> int:
+    """
+    Worker entry point: streams one partition of the rows into COPY,
+    committing every --commit-rows so a failed run keeps its progress.
+    """
+    rows, users, zipf_s, days, seed, commit_rows, device_values = args
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        loaded = 0
+        while loaded < rows:
+            batch = min(commit_rows, rows - loaded)
+            stream = RegistrationStream(batch, users, zipf_s, days, seed + loaded, device_values)
+            cursor.copy_expert(
+                "COPY device_registrations (user_key, device_type, created_at) FROM STDIN",
+                stream,
+                size=COPY_READ_SIZE
+            )
+            conn.commit()
+            loaded += batch
+        return loaded
+    finally:
+        conn.close()
+
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Bulk-load synthetic device registrations via COPY")
+    parser.add_argument("--rows", type=int, default=10_000_000, help="rows to insert (default: 10M)")
+    parser.add_argument("--users", type=int, default=1_000_000, help="distinct user keys (default: 1M)")
+    parser.add_argument("--zipf-s", type=float, default=1.1, help="Zipf exponent for user activity (default: 1.1)")
+    parser.add_argument("--days", type=positive_int, default=365,
+                        help="spread created_at over this many calendar days, today included (default: 365); "
+                             "today only runs up to now, so its later hours land on yesterday instead — "
+                             "with --days 1 that is the day before the range")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="parallel COPY connections")
+    parser.add_argument("--commit-rows", type=int, default=1_000_000, help="rows per COPY transaction")
+    parser.add_argument("--seed", type=int, default=42, help="random seed — same seed, same data")
+    parser.add_argument("--truncate", action="store_true", help="empty the table before loading")
+    parser.add_argument("--drop-index", action="store_true",
+                        help="drop the device_type index during the load and rebuild it afterwards")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    conn = get_db_connection()
+    conn.autocommit = True
+    cursor = conn.cursor()
+
+    if args.truncate:
+        print(f"{YELLOW}Truncating device_registrations...{RESET}")
+        cursor.execute("TRUNCATE device_registrations RESTART IDENTITY")
+
+    if args.drop_index:
+        print(f"{YELLOW}Dropping {DEVICE_TYPE_INDEX} for the load...{RESET}")
+        cursor.execute(f"DROP INDEX IF EXISTS {DEVICE_TYPE_INDEX}")
+
+    # COPY can't call functions — ask device_type_code() (see init.sql) what
+    # the table stores for each name: the SMALLINT code, or the name itself
+    # on a table that has not been migrated yet
+    device_values = []
+    for device_type in DEVICE_TYPE_WEIGHTS:
+        cursor.execute("SELECT device_type_code(%s)", (device_type,))
+        device_values.append(str(cursor.fetchone()[0]))
+
+    # Split rows evenly; the first workers take the remainder
+    workers = max(1, min(args.workers, args.rows))
+    base, extra = divmod(args.rows, workers)
+    partitions = [
+        (base + (1 if i < extra else 0), args.users, args.zipf_s, args.days,
+         args.seed * 1_000_003 + i * 7_919_999_983, args.commit_rows, device_values)
+        for i in range(workers)
+    ]
+
+    print(f"Loading {args.rows:,} rows ({args.users:,} users, zipf s={args.zipf_s}, "
+          f"{args.days} days) with {workers} workers...")
+    started = time.perf_counter()
+    with multiprocessing.Pool(workers) as pool:
+        loaded = sum(pool.map(load_partition, partitions))
+    elapsed = time.perf_counter() - started
+    print(f"{GREEN}✓{RESET} Loaded {loaded:,} rows in {elapsed:.1f}s ({loaded / elapsed:,.0f} rows/s)")
+
+    if args.drop_index:
+        print(f"{YELLOW}Rebuilding {DEVICE_TYPE_INDEX}...{RESET}")
+        started = time.perf_counter()
+        cursor.execute(
+            f"CREATE INDEX IF NOT EXISTS {DEVICE_TYPE_INDEX} ON device_registrations (device_type)"
+        )
+        print(f"{GREEN}✓{RESET} Index built in {time.perf_counter() - started:.1f}s")
+
+    # Fresh statistics and visibility map — otherwise the first COUNT(*)
+    # benchmarks measure autovacuum catching up, not the query
+    print(f"{YELLOW}VACUUM ANALYZE device_registrations...{RESET}")
+    cursor.execute("VACUUM ANALYZE device_registrations")
+
+    cursor.execute("""
+        SELECT COUNT(*),
+               pg_size_pretty(pg_table_size('device_registrations')),
+               pg_size_pretty(pg_indexes_size('device_registrations'))
+        FROM device_registrations
+    """)
+    total, table_size, index_size = cursor.fetchone()
+    print(f"{GREEN}✓{RESET} device_registrations: {total:,} rows, table {table_size}, indexes {index_size}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())